@@ -1,253 +1,1353 @@
-from fastapi import FastAPI, HTTPException
-from multiprocessing.managers import SyncManager
+from fastapi import FastAPI, HTTPException, Header, Response
+from fastapi.responses import PlainTextResponse
+from contextlib import asynccontextmanager
+from multiprocessing.managers import SyncManager, BaseProxy, RemoteError
 import time
 import uuid
-import traceback
 import socket
 import os
 import queue
 import json
+import threading
+import concurrent.futures
+import contextlib
+import collections
+import asyncio
+import math
+import itertools
+import random
+from typing import Optional
 
-# Set up debug printing
-def debug_print(message):
-    print(f"[APP DEBUG] {time.strftime('%H:%M:%S')} - {message}", flush=True)
+from shm_ring import ShmRing, remove_stale_rings
+import wire
+from task_scheduler import lane_for, Draining
+from hash_ring import HashRing
+from log_setup import get_logger
+from metrics import Registry
+
+# Leveled, queued logging (see log_setup.py); LOG_LEVEL=DEBUG traces every task
+log = get_logger("app")
 
 # Get hostname and process ID for processor identification
 hostname = socket.gethostname()
 process_id = os.getpid()
-debug_print(f"Starting app.py on {hostname} with PID {process_id}")
+log.info("Starting app.py on %s with PID %s", hostname, process_id)
+
+# The manager server shared by every API process, on this host or another
+MANAGER_ADDRESS = (os.environ.get("MANAGER_HOST", "127.0.0.1"), int(os.environ.get("MANAGER_PORT", "50000")))
+MANAGER_AUTHKEY = os.environ.get("MANAGER_AUTHKEY", "secret").encode()
+# Several manager servers, each with its own workers, queues and counter, as
+# "host:port,host:port". Tasks are spread across them; reads add them up.
+MANAGER_SHARDS = [
+    (host, int(port))
+    for host, port in (address.rsplit(":", 1) for address in os.environ.get("MANAGER_SHARDS", "").split(",") if address)
+] or [MANAGER_ADDRESS]
+# "hash" sends each task to the shard its key hashes to on a consistent-hash
+# ring; "least_loaded" sends it to the shard with the shortest estimated wait
+SHARD_ROUTING = os.environ.get("SHARD_ROUTING", "hash")
+# Where this API server listens, and how many uvicorn worker processes it
+# runs. Each worker process has its own manager pool and result router.
+API_HOST = os.environ.get("API_HOST", "0.0.0.0")
+API_PORT = int(os.environ.get("API_PORT", "8000"))
+API_WORKERS = int(os.environ.get("API_WORKERS", "1"))
+
+# Number of pooled manager connections shared by the request threads
+MANAGER_POOL_SIZE = int(os.environ.get("MANAGER_POOL_SIZE", "8"))
+# How long a request waits for a free pooled connection
+MANAGER_POOL_TIMEOUT = float(os.environ.get("MANAGER_POOL_TIMEOUT", "5"))
+# "shm" sends tasks and receives results through shared-memory rings when the
+# manager server runs on this host with TASK_TRANSPORT=shm; otherwise, or if
+# the ring can't be found, everything goes through the manager queues
+TASK_TRANSPORT = os.environ.get("TASK_TRANSPORT", "manager")
+SHM_RING_PREFIX = os.environ.get("SHM_RING_PREFIX", "mpf_")
+# "compact" sends tasks over the rings in the struct encoding of wire.py,
+# with integer task ids instead of UUID strings
+WIRE_FORMAT = os.environ.get("WIRE_FORMAT", "pickle")
+wire_dumps = wire.ENCODERS[WIRE_FORMAT]
+# Micro-batching: tasks submitted within BATCH_WINDOW_MS of each other, up to
+# BATCH_MAX_SIZE of them, go to the manager in one put. 1 turns it off.
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", "1"))
+BATCH_WINDOW_MS = float(os.environ.get("BATCH_WINDOW_MS", "2"))
+# One worker runs a batch serially, so slow task types are always sent alone
+BATCHABLE_TASK_TYPES = {"increment", "get"}
+# How old a cached /processor-info document may be before it is fetched again
+PROCESSOR_INFO_MAX_STALENESS = float(os.environ.get("PROCESSOR_INFO_MAX_STALENESS", "1"))
+# Admission control: most tasks this process may have waiting for a result
+# before it answers 429, and how often it polls the manager for queue depths
+MAX_PENDING_TASKS = int(os.environ.get("MAX_PENDING_TASKS", "1000"))
+ADMISSION_REFRESH_INTERVAL = float(os.environ.get("ADMISSION_REFRESH_INTERVAL", "0.25"))
+# How long a task may take end to end before the request gives up with 504
+TASK_TIMEOUT = 10
+# "manager" reads /counter and /counter-value straight from the manager
+# server; "worker" sends a get task through the queues like before
+COUNTER_READ_PATH = os.environ.get("COUNTER_READ_PATH", "manager")
+# How long a counter value read from the manager may be served again;
+# 0 reads it fresh every time, so reads always see completed writes
+COUNTER_MAX_STALENESS = float(os.environ.get("COUNTER_MAX_STALENESS", "0"))
+# Concurrent counter reads share one fetch: a request takes the result of
+# a fetch, in flight or finished, that started at most this many seconds
+# before the request came in, and otherwise waits for the next one. 0
+# only shares fetches started after the request arrived, so reads still
+# see every completed write.
+COUNTER_COALESCE_WINDOW = float(os.environ.get("COUNTER_COALESCE_WINDOW", "0"))
+# How many abandoned task ids the result router remembers, so their late
+# results can be told apart from results that were never ours
+ABANDONED_TASK_MEMORY = 10000
+# Clients send this header on /increment and /decrement so that a retry
+# gets the result of the first attempt instead of running the task again
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+# Set on responses that replay a result from the cache
+IDEMPOTENT_REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+# How often a request checks on a duplicate that another API process is
+# running for the same key
+IDEMPOTENCY_POLL_INTERVAL = float(os.environ.get("IDEMPOTENCY_POLL_INTERVAL", "0.05"))
+
+# Everything /metrics reports for this API process
+metrics = Registry()
+task_outcomes = metrics.counter(
+    "mpf_api_tasks_total", "Tasks submitted by this API process, by type and outcome (ok, timeout, error, rejected)",
+    ("task_type", "outcome"))
+task_seconds = metrics.histogram(
+    "mpf_api_task_seconds", "Time from submitting a task to receiving its result", ("task_type",))
+task_stage_seconds = metrics.histogram(
+    "mpf_api_task_stage_seconds", "Time tasks spend in each stage between the handler and the worker and back",
+    ("stage",))
+manager_connects = metrics.counter(
+    "mpf_api_manager_connects_total", "Connections opened to the manager server")
+manager_connection_errors = metrics.counter(
+    "mpf_api_manager_connection_errors_total", "Pooled manager connections dropped after an error")
+late_results = metrics.counter(
+    "mpf_api_late_results_total", "Results that arrived after their request had timed out")
+unknown_results = metrics.counter(
+    "mpf_api_unknown_results_total", "Results for tasks this process has no record of")
+counter_reads = metrics.counter(
+    "mpf_api_counter_reads_total", "Counter reads served without a worker, by source (manager, cache)", ("source",))
+cancelled_tasks = metrics.counter(
+    "mpf_api_cancelled_tasks_total", "Abandoned tasks the manager took back before any worker got them")
+idempotent_requests = metrics.counter(
+    "mpf_api_idempotent_requests_total",
+    "Requests with an idempotency key, by task type and outcome (executed, replayed, coalesced)",
+    ("task_type", "outcome"))
+rejected_tasks = metrics.counter(
+    "mpf_api_rejected_tasks_total", "Tasks turned away before reaching a worker, by type and reason (pending, wait, queue_full, draining)",
+    ("task_type", "reason"))
+shard_tasks = metrics.counter(
+    "mpf_api_shard_tasks_total", "Tasks sent to each manager server shard", ("shard",))
+decrement_retries = metrics.counter(
+    "mpf_api_decrement_retries_total", "Decrements sent on to another shard after finding their shard's counter at 0")
 
 class MyManager(SyncManager):
     pass
 
 # Register the queues and processor info with the manager
-debug_print("Registering with manager")
+log.debug("Registering with manager")
 MyManager.register('get_task_queue')
 MyManager.register('get_result_queue')
+MyManager.register('get_reply_queue')
+MyManager.register('register_reply_ring')
 MyManager.register('get_processor_info')
 MyManager.register('get_processor_info_dict')
 MyManager.register('get_processor_info_as_string')  # Register the new method
+MyManager.register('get_status_board')
 MyManager.register('update_processor_info')
+MyManager.register('get_load_report')
+MyManager.register('get_counter_reader')
+MyManager.register('get_result_cache')
+
+# Manager addresses connected to before, and those whose last connect
+# failed: only a first connect, or one after a failure, is logged at INFO
+connected_addresses = set()
+failed_addresses = set()
 
-def get_manager():
-    debug_print(f"get_manager called by {hostname}:{process_id}")
+def get_manager(address=MANAGER_ADDRESS):
+    log.debug("get_manager called by %s:%s", hostname, process_id)
     # Connect to the manager server
     try:
-        debug_print("Connecting to manager server at 127.0.0.1:50000")
-        m = MyManager(address=('127.0.0.1', 50000), authkey=b'secret')
+        log.debug("Connecting to manager server at %s:%s", address[0], address[1])
+        m = MyManager(address=address, authkey=MANAGER_AUTHKEY)
         m.connect()
-        debug_print("Connected to manager server successfully")
+        manager_connects.inc()
+        if address not in connected_addresses or address in failed_addresses:
+            log.info("Connected to manager server at %s:%s", address[0], address[1])
+            connected_addresses.add(address)
+            failed_addresses.discard(address)
+        else:
+            log.debug("Connected to manager server at %s:%s", address[0], address[1])
         return m
     except Exception as e:
-        debug_print(f"Error connecting to manager: {e}")
-        debug_print(traceback.format_exc())
+        failed_addresses.add(address)
+        log.exception("Error connecting to manager: %s", e)
         raise
 
-app = FastAPI()
+def reset_thread_connection(address):
+    """Forget this thread's cached socket to a manager that has gone away.
 
-def process_task(task_type, timeout=10):
-    """Helper function to process a task and wait for the result with timeout"""
-    api_server = f"{hostname}:{process_id}"
-    debug_print(f"process_task called with task_type={task_type}, timeout={timeout} by {api_server}")
-    
-    # Get the manager and queues
-    try:
-        manager = get_manager()
-        debug_print("Got manager")
-        
-        task_queue = manager.get_task_queue()
-        debug_print(f"Got task queue: {type(task_queue)}")
+    Proxies share one socket per manager address and thread, so after a
+    manager restart the stale socket has to be dropped before new proxies
+    can work from this thread.
+    """
+    tls_idset = BaseProxy._address_to_local.get(address)
+    if tls_idset is None:
+        return
+    tls = tls_idset[0]
+    connection = getattr(tls, 'connection', None)
+    if connection is not None:
+        try:
+            connection.close()
+        except Exception:
+            pass
+        del tls.connection
+
+class ManagerConnection:
+    """A manager connection with its proxies created once and reused"""
+
+    def __init__(self, address):
+        self.manager = get_manager(address)
+        self.task_queue = self.manager.get_task_queue()
+        self.status_board = self.manager.get_status_board()
+        self.counter_reader = self.manager.get_counter_reader()
+        self.result_cache = self.manager.get_result_cache()
+
+class ManagerPool:
+    """Fixed-size pool of manager connections shared by the request threads.
+
+    A connection is checked out for the duration of one request, so no two
+    threads use the same proxies at once. Connections that fail with a
+    connection error are dropped and re-created on their next checkout.
+    """
+
+    def __init__(self, address, size, timeout):
+        self.address = address
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.Queue()
+        # None marks a slot that still needs to connect
+        for _ in range(size):
+            self._idle.put(None)
+
+    def open(self):
+        """Connect every slot up front so the first requests don't pay for it"""
+        slots = [self._idle.get() for _ in range(self.size)]
+        try:
+            for i, conn in enumerate(slots):
+                if conn is None:
+                    slots[i] = ManagerConnection(self.address)
+            log.info("Opened manager pool with %s connections", self.size)
+        except Exception as e:
+            log.warning("Could not open all pooled connections, will retry on demand: %s", e)
+        finally:
+            for conn in slots:
+                self._idle.put(conn)
+
+    def close(self):
+        for _ in range(self.size):
+            self._idle.get()
+        for _ in range(self.size):
+            self._idle.put(None)
+        log.info("Closed manager pool")
+
+    @contextlib.contextmanager
+    def connection(self, fresh=False):
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise RuntimeError(f"No manager connection available after {self.timeout}s")
+        try:
+            if conn is None or fresh:
+                conn = ManagerConnection(self.address)
+            yield conn
+        except (ConnectionError, EOFError, OSError, RemoteError) as e:
+            # RemoteError here usually means the proxies belong to a manager
+            # that has since restarted
+            log.warning("Dropping broken manager connection: %s", e)
+            manager_connection_errors.inc()
+            reset_thread_connection(self.address)
+            conn = None
+            raise
+        finally:
+            self._idle.put(conn)
+
+    def in_use(self):
+        return self.size - self._idle.qsize()
+
+    def call(self, fn):
+        """Run fn(conn) on a pooled connection, retrying once on a fresh
+        connection if the pooled one turns out to be stale"""
+        try:
+            with self.connection() as conn:
+                return fn(conn)
+        except (ConnectionError, EOFError, OSError, RemoteError):
+            with self.connection(fresh=True) as conn:
+                return fn(conn)
+
+class ResultRouter:
+    """Routes results from this API process's reply queue on one shard to the
+    waiting requests.
+
+    One dispatcher thread blocks on the reply queue and resolves the asyncio
+    future registered for each task_id on the event loop that is awaiting it,
+    so every result is delivered exactly once and waiters don't hold a thread.
+
+    A waiter that gives up abandons its task: the router asks the manager
+    to cancel it, and drops the result if a worker ran it anyway. Tasks
+    with an idempotency key are left to run instead, and their results,
+    late or not, go to the manager's result cache for retries to find.
+    """
+
+    def __init__(self, reply_to, shard):
+        self.reply_to = reply_to
+        self.shard = shard
+        self._pending = {}
+        self._abandoned = collections.OrderedDict()
+        self._to_cancel = []
+        # Tasks with an idempotency key, and their results still to record
+        self._keyed = collections.OrderedDict()
+        self._to_complete = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._reply_ring = None
+        # Whether the manager server knows our reply ring; a restarted one
+        # doesn't until we register it again
+        self.ring_registered = False
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            # Fetch the reply queue before the first task is submitted so
+            # workers can find it when they finish
+            self._reply_queue = self._connect()
+            self._thread = threading.Thread(target=self._dispatch_loop, name=f"result-router-{self.shard.index}", daemon=True)
+            self._thread.start()
+            log.info("Result router started for %s on %s", self.reply_to, self.shard.name)
+
+    def _connect(self):
+        if not self.shard.task_rings:
+            # The dispatcher blocks on this proxy, so it gets a connection of its own
+            return get_manager(self.shard.address).get_reply_queue(self.reply_to)
         
-        result_queue = manager.get_result_queue()
-        debug_print(f"Got result queue: {type(result_queue)}")
+        # Workers on this host write results straight into our own ring
+        if self._reply_ring is None:
+            # Reply rings of API processes that were killed are never unlinked
+            stale = remove_stale_rings(f"{SHM_RING_PREFIX}reply_")
+            if stale:
+                log.info("Removed %s reply ring(s) of API processes that have exited", len(stale))
+            self._reply_ring = ShmRing(f"{SHM_RING_PREFIX}reply_{process_id}_{self.shard.index}", create=True)
+        self.register_ring()
+        return self._reply_ring
+
+    def register_ring(self):
+        """Tell the manager server where to send our results, over the pool"""
+        ring = self._reply_ring
+        self.shard.pool.call(lambda conn: conn.manager.register_reply_ring(self.reply_to, ring.name))
+        self.ring_registered = True
+
+    def reregister_ring(self):
+        """Register the reply ring again if the manager server restarted
+        since it was registered. Returns whether it did."""
+        if self.ring_registered or self._reply_ring is None:
+            return False
+        self.register_ring()
+        return True
+
+    def close(self):
+        if self._reply_ring is not None:
+            self._reply_ring.unlink()
+
+    def register(self, task_id, keyed=False):
+        future = asyncio.get_running_loop().create_future()
+        with self._lock:
+            self._pending[task_id] = future
+            if keyed:
+                self._keyed[task_id] = True
+                if len(self._keyed) > ABANDONED_TASK_MEMORY:
+                    self._keyed.popitem(last=False)
+        return future
+
+    def discard(self, task_id):
+        with self._lock:
+            self._pending.pop(task_id, None)
+
+    def abandon(self, task_id):
+        """Stop waiting for task_id and cancel it on the manager"""
+        with self._lock:
+            self._pending.pop(task_id, None)
+            self._abandoned[task_id] = True
+            if len(self._abandoned) > ABANDONED_TASK_MEMORY:
+                self._abandoned.popitem(last=False)
+            if task_id in self._keyed:
+                # A retry with the same key will pick up its result
+                return
+            self._to_cancel.append(task_id)
+            # Cancels that pile up while one is in flight go in the next call
+            if len(self._to_cancel) == 1:
+                manager_executor.submit(self._send_cancels)
+
+    def _send_cancels(self):
+        with self._lock:
+            task_ids, self._to_cancel = self._to_cancel, []
+        try:
+            removed = self.shard.pool.call(lambda conn: conn.task_queue.cancel(task_ids))
+            cancelled_tasks.inc(amount=removed)
+            log.debug("Cancelled %s task(s), %s still queued", len(task_ids), removed)
+        except Exception as e:
+            log.warning("Could not cancel %s abandoned task(s): %s", len(task_ids), e)
+
+    def _send_completions(self):
+        with self._lock:
+            results, self._to_complete = self._to_complete, []
+        try:
+            self.shard.pool.call(lambda conn: conn.result_cache.complete(results))
+        except Exception as e:
+            log.warning("Could not record %s idempotent result(s): %s", len(results), e)
+
+    def pending(self):
+        return len(self._pending)
+
+    def fail_pending(self, make_error):
+        """Fail every waiting request with make_error(), for a shard that
+        has gone away with their tasks"""
+        with self._lock:
+            futures, self._pending = list(self._pending.values()), {}
+        for future in futures:
+            future.get_loop().call_soon_threadsafe(_fail, future, make_error())
+        return len(futures)
+
+    def _dispatch_loop(self):
+        reply_queue = self._reply_queue
+        while True:
+            try:
+                result_data = reply_queue.get()
+            except Exception as e:
+                log.warning("Result router lost its reply queue: %s, reconnecting", e)
+                reset_thread_connection(self.shard.address)
+                time.sleep(1)
+                try:
+                    reply_queue = self._connect()
+                except Exception as e:
+                    log.warning("Result router could not reconnect: %s", e)
+                continue
+            
+            # Compact results come over a manager reply queue as bytes
+            if isinstance(result_data, bytes):
+                result_data = wire.loads(result_data)
+            # Workers send a list when they ran a batch for this process
+            results = result_data if isinstance(result_data, list) else [result_data]
+            for result_data in results:
+                with self._lock:
+                    future = self._pending.pop(result_data[0], None)
+                    abandoned = future is None and self._abandoned.pop(result_data[0], None)
+                    if self._keyed.pop(result_data[0], None):
+                        self._to_complete.append((result_data[0], result_data))
+                        if len(self._to_complete) == 1:
+                            manager_executor.submit(self._send_completions)
+                if abandoned:
+                    log.debug("Dropping late result for abandoned task %s", result_data[0])
+                    late_results.inc()
+                    continue
+                if future is None:
+                    log.warning("Dropping result for unknown task %s", result_data[0])
+                    unknown_results.inc()
+                    continue
+                future.get_loop().call_soon_threadsafe(_resolve, future, (result_data, time.monotonic()))
+
+def _resolve(future, delivery):
+    # The waiter may have timed out between the pop and this callback
+    if not future.done():
+        future.set_result(delivery)
+
+def _fail(future, error):
+    if not future.done():
+        future.set_exception(error)
+
+api_server = f"{hostname}:{process_id}"
+
+# Compact task ids: random high 32 bits for this process and a counter
+# below them, so ids from different API processes don't collide
+compact_task_ids = itertools.count(random.getrandbits(32) << 32)
+
+def new_task_id():
+    if WIRE_FORMAT == "compact":
+        return next(compact_task_ids)
+    return str(uuid.uuid4())
+
+def overloaded(status_code, detail, retry_after):
+    return HTTPException(status_code=status_code, detail=detail,
+                         headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+def shard_gone():
+    return overloaded(503, "Manager server shut down before the task ran", 1)
+
+class AdmissionController:
+    """Turns tasks away up front when they can't finish in time.
+
+    A thread polls the manager server for how many tasks wait in each lane
+    and how many workers can serve it, and results feed a moving average
+    of how long each lane's tasks run. A task gets 429 when this process
+    already has max_pending tasks waiting, and 503 when the wait in its
+    lane plus its own run time would exceed its timeout. Either way the
+    client hears back at once with a Retry-After, rather than with a 504
+    after the timeout, and no worker runs a task nobody is waiting for.
+
+    The load report also says when the manager server is draining. Its
+    shard then gets no new tasks until a poll finds a new server process
+    serving, which the poll attaches to the task rings of and registers
+    our reply ring with. When a draining server goes away, the requests
+    still waiting on it fail at once, since nothing will run their tasks.
+    """
+
+    # Weight of the newest run time in the moving average
+    SMOOTHING = 0.2
+
+    def __init__(self, shard, max_pending, refresh_interval):
+        self.shard = shard
+        self.max_pending = max_pending
+        self.refresh_interval = refresh_interval
+        # Last snapshot from the manager's load report, None until the first poll
+        self._load = None
+        # Tasks this process sent to each lane since that snapshot
+        self._sent = {}
+        self._run_seconds = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.draining = False
+        # Whether the last poll reached the manager server, and which
+        # server process it was
+        self.reachable = False
+        self._server = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._poll_loop, name=f"admission-{self.shard.index}", daemon=True)
+            self._thread.start()
+
+    def _poll_loop(self):
+        report = None
+        while True:
+            try:
+                if report is None:
+                    report = get_manager(self.shard.address).get_load_report()
+                load = report.snapshot()
+                server = load.get("server")
+                if self._server is not None and server != self._server:
+                    # A new server process made new rings under the old names,
+                    # and doesn't know our reply ring
+                    log.info("Manager server %s restarted", self.shard.name)
+                    if TASK_TRANSPORT == "shm":
+                        self.shard.attach_task_rings()
+                    self.shard.router.ring_registered = False
+                self._server = server
+                try:
+                    if self.shard.router.reregister_ring():
+                        log.info("Registered reply ring with %s again", self.shard.name)
+                except Exception as e:
+                    # Tried again on the next poll
+                    log.warning("Could not register reply ring with %s: %s", self.shard.name, e)
+                if load.get("draining") and not self.draining:
+                    log.warning("Manager server %s is draining, sending it no new tasks", self.shard.name)
+                self.draining = load.get("draining", False)
+                self.reachable = True
+                with self._lock:
+                    self._load = load
+                    self._sent = {}
+            except Exception as e:
+                log.debug("Admission could not poll the manager: %s", e)
+                report = None
+                self.reachable = False
+                reset_thread_connection(self.shard.address)
+                if self.draining:
+                    # It has drained and exited; what it didn't run never will
+                    failed = self.shard.router.fail_pending(shard_gone)
+                    if failed:
+                        log.warning("Manager server %s exited with %s task(s) of ours unrun", self.shard.name, failed)
+                # Admit everything rather than act on stale depths
+                with self._lock:
+                    self._load = None
+                time.sleep(1)
+                continue
+            time.sleep(self.refresh_interval)
+
+    def lane(self, task_type):
+        load = self._load
+        if load is None:
+            return None
+        return load["lanes"]["types"].get(task_type, load["lanes"]["default"])
+
+    def estimated_wait(self, lane):
+        """Seconds until a worker would pick up a task sent to lane now"""
+        with self._lock:
+            load = self._load
+            if load is None:
+                return 0
+            queued = load["queued"].get(lane, 0) + self._sent.get(lane, 0)
+            return queued * self._run_seconds.get(lane, 0) / max(1, load["capacity"].get(lane, 1))
+
+    def admit(self, task_type, timeout):
+        """Raise an HTTPException if the task should not be submitted"""
+        if self.draining:
+            rejected_tasks.inc(task_type, "draining")
+            raise overloaded(503, "Manager server is draining", 1)
+        if pending_tasks() >= self.max_pending:
+            rejected_tasks.inc(task_type, "pending")
+            raise overloaded(429, "Too many tasks in flight on this API server", 1)
+        lane = self.lane(task_type)
+        if lane is None:
+            return
+        wait = self.estimated_wait(lane)
+        run_seconds = self._run_seconds.get(lane, 0)
+        if wait + run_seconds > timeout:
+            rejected_tasks.inc(task_type, "wait")
+            raise overloaded(503, f"Workers are busy, estimated wait {wait:.1f}s", wait + run_seconds - timeout)
+        with self._lock:
+            self._sent[lane] = self._sent.get(lane, 0) + 1
+
+    def observe(self, task_type, trace):
+        """Fold a finished task's run time into its lane's average"""
+        lane = self.lane(task_type)
+        if lane is None or trace is None:
+            return
+        seconds = trace["completed"] - trace["picked_up"]
+        with self._lock:
+            previous = self._run_seconds.get(lane)
+            self._run_seconds[lane] = seconds if previous is None else previous + self.SMOOTHING * (seconds - previous)
+
+
+# Blocking manager calls run here so the event loop never waits on a socket
+manager_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=MANAGER_POOL_SIZE, thread_name_prefix="manager-call")
+
+async def run_in_manager_thread(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(manager_executor, fn, *args)
+
+def put_tasks(conn, message):
+    log.debug("Putting task message in queue: %s", message)
+    # A full lane raises queue.Full rather than making us wait for room
+    conn.task_queue.put(message, False)
+    log.debug("Task message put in queue successfully")
+
+async def send_task_message(shard, message):
+    """Send one task or a batch to the shard's workers over the fastest transport"""
+    if shard.task_rings:
+        lane = lane_for(message, shard.task_lanes["types"], shard.task_lanes["default"])
+        try:
+            # A ring put never waits on another process, so it's fine inline
+            shard.task_rings[lane].put(message, block=False)
+            return
+        except ValueError as e:
+            log.warning("Task ring can't take this message (%r), using the manager queue", e)
+    await run_in_manager_thread(shard.pool.call, lambda conn: put_tasks(conn, message))
+
+class TaskBatcher:
+    """Coalesces task submissions into one task_queue.put per batch.
+
+    The first batchable task starts a window of `window` seconds; everything
+    submitted before it closes, up to max_size tasks, goes to the manager
+    as a single list. Each submitter awaits the put of its own batch.
+    """
+
+    def __init__(self, shard, max_size, window):
+        self.shard = shard
+        self.max_size = max_size
+        self.window = window
+        self._batch = []
+        self._flush_handle = None
+
+    async def submit(self, task):
+        if self.max_size <= 1 or task[1] not in BATCHABLE_TASK_TYPES:
+            await send_task_message(self.shard, task)
+            return
         
-        processor_info = manager.get_processor_info()
-        debug_print(f"Got processor info: {processor_info}")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._batch.append((task, future))
+        if len(self._batch) >= self.max_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self._flush)
+        await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._batch = self._batch, []
+        if batch:
+            asyncio.ensure_future(self._send(batch))
+
+    async def _send(self, batch):
+        tasks = [task for task, _ in batch]
+        message = tasks[0] if len(tasks) == 1 else tasks
+        try:
+            await send_task_message(self.shard, message)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+
+class ManagerShard:
+    """One manager server and everything this API process keeps for it: a
+    connection pool, a result router, admission control, a batcher, and
+    the server's shared-memory task rings when it runs on this host"""
+
+    def __init__(self, index, address):
+        self.index = index
+        self.address = address
+        self.name = f"{address[0]}:{address[1]}"
+        self.pool = ManagerPool(address, MANAGER_POOL_SIZE, MANAGER_POOL_TIMEOUT)
+        self.router = ResultRouter(api_server, self)
+        self.admission = AdmissionController(self, MAX_PENDING_TASKS, ADMISSION_REFRESH_INTERVAL)
+        self.batcher = TaskBatcher(self, BATCH_MAX_SIZE, BATCH_WINDOW_MS / 1000)
+        # Task rings (one per lane) and which lane each task type goes to
+        self.task_rings = {}
+        self.task_lanes = None
+
+    def attach_task_rings(self):
+        try:
+            manager = get_manager(self.address)
+            info = manager.get_processor_info()
+            ring_names = info.get('task_rings')
+            if not ring_names:
+                log.info("Manager server %s has no task rings, using the manager queues", self.name)
+                return
+            rings = {lane: ShmRing.attach(name, dumps=wire_dumps) for lane, name in ring_names.items()}
+            self.task_lanes = info.get('task_lanes')
+            self.task_rings = rings
+            log.info("Attached to shared-memory task rings %s", ", ".join(ring_names.values()))
+        except Exception as e:
+            log.warning("Could not attach to the task rings of %s, using the manager queues: %s", self.name, e)
+
+shards = [ManagerShard(index, address) for index, address in enumerate(MANAGER_SHARDS)]
+shard_ring = HashRing(shards, name=lambda shard: shard.name)
+shard_turns = itertools.count()
+
+def serving(shard):
+    return shard.admission.reachable and not shard.admission.draining
+
+def pick_shard(task_type, key):
+    """The shard a task goes to: by consistent hash of key, or the one
+    whose lane for task_type has the shortest estimated wait. Shards that
+    are draining, or that admission can't reach, are passed over while
+    any other shard is serving."""
+    if len(shards) == 1:
+        return shards[0]
+    if SHARD_ROUTING == "least_loaded":
+        # Start from a different shard each time so ties take turns
+        start = next(shard_turns) % len(shards)
+        candidates = [shard for shard in shards[start:] + shards[:start] if serving(shard)] or shards
+        return min(candidates, key=lambda shard: (
+            shard.admission.estimated_wait(shard.admission.lane(task_type)), shard.router.pending()))
+    return shard_ring.node_for(key, serving)
+
+def pending_tasks():
+    return sum(shard.router.pending() for shard in shards)
+
+metrics.gauge("mpf_api_manager_pool_size", "Pooled manager connections", lambda: sum(shard.pool.size for shard in shards))
+metrics.gauge("mpf_api_manager_pool_in_use", "Pooled manager connections checked out right now", lambda: sum(shard.pool.in_use() for shard in shards))
+metrics.gauge("mpf_api_pending_tasks", "Tasks submitted by this process still waiting for a result", pending_tasks)
+metrics.gauge("mpf_api_draining_shards", "Manager server shards that are draining or have drained and not come back",
+              lambda: sum(shard.admission.draining for shard in shards))
+
+@asynccontextmanager
+async def lifespan(app):
+    for shard in shards:
+        shard.pool.open()
+        if TASK_TRANSPORT == "shm":
+            shard.attach_task_rings()
+        shard.admission.start()
+        try:
+            shard.router.start()
+        except Exception as e:
+            log.warning("Result router for %s not started, will retry on first request: %s", shard.name, e)
+    yield
+    manager_executor.shutdown(wait=False)
+    for shard in shards:
+        shard.pool.close()
+        shard.router.close()
+
+app = FastAPI(lifespan=lifespan)
+
+# Header that asks for a task's timing breakdown in the response
+TIMING_HEADER = "X-Debug-Timing"
+
+def task_timing(received, enqueued, sent, delivered, responded, trace):
+    """Break one task's latency into stages, in milliseconds.
+
+    Stamps are time.monotonic(), which all processes on a host share, so
+    the worker's stamps in trace line up with ours when the manager
+    server runs on this host.
+    """
+    stages = {
+        # Router start, task id and tuple before the task is handed off
+        "setup": enqueued - received,
+        # The put call itself, batching window included (overlaps "queue")
+        "put": sent - enqueued,
+    }
+    if trace is not None:
+        stages.update({
+            # Until a worker took it off the task queue or ring
+            "queue": trace["picked_up"] - enqueued,
+            # Inside the worker, waiting for the counter lock
+            "lock_wait": trace["lock_wait"],
+            # Inside the worker, everything else up to the result
+            "work": trace["completed"] - trace["picked_up"] - trace["lock_wait"],
+            # Result put-back, reply queue IPC and the router thread
+            "reply": delivered - trace["completed"],
+        })
+    # From the router handing over the result to this coroutine resuming
+    stages["resume"] = responded - delivered
+    stages["total"] = responded - received
+    return {stage: round(seconds * 1000, 3) for stage, seconds in stages.items()}
+
+def server_timing(timing):
+    """Format a timing breakdown as a Server-Timing header value"""
+    return ", ".join(f"{stage};dur={ms}" for stage, ms in timing.items())
+
+async def process_task(task_type, timeout=TASK_TIMEOUT, timing=False, shard=None, task_id=None, keyed=False, tried=()):
+    """Submit a task and await its result without holding a thread while waiting.
+
+    The task goes to the given shard, or to the one pick_shard chooses,
+    and to another one if that one turns out to be draining. A decrement
+    that finds its shard's counter at 0 goes on to a shard, not in tried,
+    whose counter isn't.
+    keyed marks a task that holds an idempotency key's claim under task_id.
+    With timing=True the result includes the task's stage breakdown.
+    """
+    received = time.monotonic()
+    log.debug("process_task called with task_type=%s, timeout=%s by %s", task_type, timeout, api_server)
+    
+    # Generate a unique task ID
+    if task_id is None:
+        task_id = new_task_id()
+    log.debug("Generated task_id=%s", task_id)
+    pinned = shard is not None
+    if shard is None:
+        shard = pick_shard(task_type, str(task_id))
+    result_router = shard.router
+    
+    try:
+        if not result_router.running:
+            await run_in_manager_thread(result_router.start)
     except Exception as e:
-        debug_print(f"Error getting manager resources: {e}")
-        debug_print(traceback.format_exc())
+        log.exception("Error starting result router: %s", e)
         raise HTTPException(status_code=500, detail=f"Error connecting to task manager: {str(e)}")
     
-    # Generate a unique task ID
-    task_id = str(uuid.uuid4())
-    debug_print(f"Generated task_id={task_id}")
+    # Turn the task away now if it would only time out in the queue
+    try:
+        shard.admission.admit(task_type, timeout)
+    except HTTPException:
+        task_outcomes.inc(task_type, "rejected")
+        raise
+    shard_tasks.inc(shard.name)
+    
+    # Register the waiter before submitting so the result can't arrive first
+    future = result_router.register(task_id, keyed)
     
-    # Put the task in the queue with its ID
+    # Put the task in the queue with its ID and where to send the result
     try:
-        debug_print(f"Putting task in queue: task_id={task_id}, type={task_type}")
-        task_queue.put((task_id, task_type))
-        debug_print("Task put in queue successfully")
-        
-        # Record which API server submitted this task
-        try:
-            # Use the update_processor_info method instead of direct assignment
-            manager.update_processor_info(f'api_server_{task_id}', api_server)
-            debug_print(f"Updated processor info with api_server_{task_id}={api_server}")
-        except Exception as e:
-            debug_print(f"Warning: Could not update processor info: {e}")
-        
-        # Debug: Check queue size if possible
-        try:
-            debug_print(f"Task queue size: {task_queue.qsize()}")
-        except Exception as e:
-            debug_print(f"Cannot get queue size: {e}")
+        # The worker records which API server submitted the task from reply_to,
+        # measures queueing delay from the enqueue time, and drops the task
+        # unrun once the deadline (wall clock, as it may be on another host)
+        # has passed, since we will have answered 504 by then
+        enqueued = time.monotonic()
+        deadline = time.time() + timeout
+        await shard.batcher.submit((task_id, task_type, api_server, enqueued, deadline))
+        sent = time.monotonic()
+    except queue.Full:
+        result_router.discard(task_id)
+        task_outcomes.inc(task_type, "rejected")
+        rejected_tasks.inc(task_type, "queue_full")
+        log.warning("Task queue for %s tasks is full, rejecting", task_type)
+        raise overloaded(503, "Task queue is full", 1)
+    except Draining:
+        # It started draining since admission last polled it
+        result_router.discard(task_id)
+        shard.admission.draining = True
+        if not pinned and any(serving(other) for other in shards):
+            return await process_task(task_type, timeout, timing, task_id=task_id, keyed=keyed)
+        task_outcomes.inc(task_type, "rejected")
+        rejected_tasks.inc(task_type, "draining")
+        raise overloaded(503, "Manager server is draining", 1)
     except Exception as e:
-        debug_print(f"Error putting task in queue: {e}")
-        debug_print(traceback.format_exc())
+        result_router.discard(task_id)
+        task_outcomes.inc(task_type, "error")
+        log.exception("Error putting task in queue: %s", e)
         raise HTTPException(status_code=500, detail=f"Error submitting task: {str(e)}")
     
-    # Wait for the result with timeout
-    debug_print(f"Waiting for result with timeout={timeout}")
-    start_time = time.time()
+    # Wait for the router to hand us our result
+    log.debug("Waiting for result with timeout=%s", timeout)
+    try:
+        result_data, delivered = await asyncio.wait_for(future, timeout)
+    except asyncio.CancelledError:
+        # The request itself was cancelled; nobody will read this result
+        result_router.abandon(task_id)
+        raise
+    except asyncio.TimeoutError:
+        result_router.abandon(task_id)
+        task_outcomes.inc(task_type, "timeout")
+        log.warning("Timed out waiting for result after %ss", timeout)
+        raise HTTPException(status_code=504, detail="Task processing timed out")
+    except HTTPException:
+        # The shard went away with our task (see fail_pending)
+        task_outcomes.inc(task_type, "error")
+        raise
+    
+    responded = time.monotonic()
+    task_outcomes.inc(task_type, "ok")
+    shard.admission.observe(task_type, result_data[3] if len(result_data) == 4 else None)
+    task_seconds.observe(responded - received, task_type)
+    
+    # Unpack the result data
+    trace = None
+    if len(result_data) == 4:
+        result_id, result, processor, trace = result_data
+    elif len(result_data) == 3:
+        result_id, result, processor = result_data
+    else:
+        result_id, result = result_data
+        processor = "unknown"
+    
+    stages = task_timing(received, enqueued, sent, delivered, responded, trace)
+    for stage, ms in stages.items():
+        if stage != "total":
+            task_stage_seconds.observe(ms / 1000, stage)
     
-    while time.time() - start_time < timeout:
-        # Check if there's a result
+    log.debug("Got result: result_id=%s, result=%s, processor=%s, timing=%s", result_id, result, processor, stages)
+    
+    if trace is not None and trace.get("noop") and len(shards) > 1:
+        # Each shard's counter stops at 0 on its own, but the total may not be 0
+        tried += (shard,)
+        remaining = timeout - (responded - received)
+        other = await shard_with_count(tried) if remaining > 0 else None
+        if other is not None:
+            decrement_retries.inc()
+            log.debug("Counter of %s is at 0, sending decrement %s on to %s", shard.name, task_id, other.name)
+            return await process_task(task_type, remaining, timing, shard=other, task_id=task_id, keyed=keyed, tried=tried)
+    
+    response = {
+        "counter": result,
+        "processor": processor,
+        "api_server": api_server,
+        "task_id": str(task_id)
+    }
+    if timing:
+        response["timing"] = stages
+    return response
+
+async def shard_with_count(exclude):
+    """The serving shard, not in exclude, with the highest counter above 0,
+    or None if there is none"""
+    candidates = [shard for shard in shards if shard not in exclude and serving(shard)]
+    reads = await asyncio.gather(
+        *(run_in_manager_thread(shard.pool.call, fetch_counter) for shard in candidates), return_exceptions=True)
+    counts = [(read[0], shard) for shard, read in zip(candidates, reads) if not isinstance(read, BaseException)]
+    value, shard = max(counts, key=lambda count: count[0], default=(0, None))
+    return shard if value > 0 else None
+
+async def counter_total(fallback):
+    """The counter added up over every shard, or fallback if a shard can't be read"""
+    try:
+        value, _ = await manager_counter_reads()
+        return value
+    except Exception as e:
+        log.warning("Could not add up the shard counters: %s", e)
+        return fallback
+
+def replayed_result(result_data, received, timing):
+    """A cached result in the shape process_task returns"""
+    task_id, result, processor = result_data[:3]
+    response = {
+        "counter": result,
+        "processor": processor,
+        "api_server": api_server,
+        # The task that ran for the first request with this key
+        "task_id": str(task_id),
+        "replayed": True,
+    }
+    if timing:
+        # The cache lookup is the whole request
+        ms = round((time.monotonic() - received) * 1000, 3)
+        response["timing"] = {"read": ms, "total": ms}
+    return response
+
+async def claim_and_run(task_type, cache_key, timing):
+    """Run the task for cache_key unless it has already run or is running,
+    in which case return (or wait for) that run's result"""
+    received = time.monotonic()
+    deadline = received + TASK_TIMEOUT
+    # Keys always go by hash, so every retry finds the same shard's cache
+    # (unless that shard is draining, and its cache about to go with it)
+    shard = shard_ring.node_for(cache_key, serving)
+    task_id = new_task_id()
+    waited = False
+    while True:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            task_outcomes.inc(task_type, "timeout")
+            raise HTTPException(status_code=504, detail="Task processing timed out")
+        claim_deadline = time.time() + timeout
         try:
-            # Try to get a result with a timeout
-            debug_print("Checking for result...")
+            state, value = await run_in_manager_thread(
+                shard.pool.call, lambda conn: conn.result_cache.claim(cache_key, task_id, claim_deadline))
+        except Exception as e:
+            log.exception("Error claiming idempotency key: %s", e)
+            raise HTTPException(status_code=500, detail=f"Error checking idempotency key: {str(e)}")
+        if state == "done":
+            idempotent_requests.inc(task_type, "coalesced" if waited else "replayed")
+            return replayed_result(value, received, timing)
+        if state == "claimed":
+            break
+        # Another API process is running it; its result will be cached
+        waited = True
+        await asyncio.sleep(IDEMPOTENCY_POLL_INTERVAL)
+
+    idempotent_requests.inc(task_type, "executed")
+    try:
+        return await process_task(task_type, timeout, timing, shard=shard, task_id=task_id, keyed=True)
+    except HTTPException as e:
+        if e.status_code != 504:
+            # The task was never sent, so a retry should run it
             try:
-                debug_print("About to call result_queue.get(timeout=0.5)")
-                result_data = result_queue.get(timeout=0.5)
-                
-                # Unpack the result data
-                if len(result_data) == 3:
-                    result_id, result, processor = result_data
-                else:
-                    result_id, result = result_data
-                    processor = "unknown"
-                    
-                debug_print(f"Got result: result_id={result_id}, result={result}, processor={processor}")
-                
-                # If this is our result, return it
-                if result_id == task_id:
-                    debug_print(f"Result matches our task_id, returning result={result}")
-                    return {
-                        "counter": result,
-                        "processor": processor,
-                        "api_server": api_server,
-                        "task_id": task_id
-                    }
-                else:
-                    debug_print(f"Result is for a different task (expected {task_id}, got {result_id}), continuing to wait")
-                    # Put the result back for another process to pick up
-                    result_queue.put(result_data)
-            except queue.Empty:
-                # No result yet
-                elapsed = time.time() - start_time
-                debug_print(f"Queue Empty exception, waited {elapsed:.1f}s so far")
-            except Exception as e:
-                # Error getting result
-                elapsed = time.time() - start_time
-                debug_print(f"Error in result_queue.get(): {e}, waited {elapsed:.1f}s so far")
-                debug_print(f"Exception type: {type(e)}")
-                debug_print(traceback.format_exc())
+                await run_in_manager_thread(shard.pool.call, lambda conn: conn.result_cache.release([task_id]))
+            except Exception as release_error:
+                log.warning("Could not release idempotency key: %s", release_error)
+        raise
+
+# Requests with an idempotency key this process is running, by key, so
+# concurrent duplicates wait on one execution without asking the manager
+idempotent_inflight = {}
+
+async def run_idempotent_task(task_type, key, timing=False):
+    """process_task for a request with an idempotency key: the task runs
+    once per key, and duplicates and retries get that run's result"""
+    if len(key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"{IDEMPOTENCY_HEADER} is longer than {MAX_IDEMPOTENCY_KEY_LENGTH} characters")
+    cache_key = f"{task_type}:{key}"
+    inflight = idempotent_inflight.get(cache_key)
+    if inflight is not None:
+        received = time.monotonic()
+        idempotent_requests.inc(task_type, "coalesced")
+        first = await asyncio.shield(inflight)
+        # Answered like a duplicate from another process, with the timing
+        # this request asked for rather than whatever the first one did
+        return replayed_result((first["task_id"], first["counter"], first["processor"]), received, timing)
+    inflight = idempotent_inflight[cache_key] = asyncio.get_running_loop().create_future()
+    try:
+        result = await claim_and_run(task_type, cache_key, timing)
+        inflight.set_result(result)
+        return result
+    except Exception as e:
+        inflight.set_exception(e)
+        raise
+    finally:
+        del idempotent_inflight[cache_key]
+        if not inflight.done():
+            # Cancelled along with its request
+            inflight.set_exception(HTTPException(status_code=503, detail="Request with this idempotency key was cancelled"))
+        # Marks any exception retrieved, in case no duplicate was waiting
+        inflight.exception()
+
+async def run_endpoint_task(task_type, response, debug_timing, idempotency_key=None):
+    """process_task for an endpoint, adding the timing breakdown when the
+    request asked for it with the X-Debug-Timing header, and going through
+    the idempotency cache when it sent an Idempotency-Key"""
+    if idempotency_key:
+        result = await run_idempotent_task(task_type, idempotency_key, timing=bool(debug_timing))
+        if result.pop("replayed", False):
+            response.headers[IDEMPOTENT_REPLAYED_HEADER] = "true"
+    else:
+        result = await process_task(task_type, timing=bool(debug_timing))
+    if len(shards) > 1:
+        # Answer with the counter the client sees, not the one shard's part of it
+        result["counter"] = await counter_total(result["counter"])
+    if debug_timing:
+        response.headers["Server-Timing"] = server_timing(result["timing"])
+    return result
+
+def fetch_counter(conn):
+    return conn.counter_reader.read()
+
+class SingleFlight:
+    """Shares one call of an async function among concurrent callers.
+
+    A caller shares the last call, in flight or finished, if it started no
+    more than window seconds ago; a call that failed isn't shared once it
+    has finished. Otherwise a caller that finds a call in flight waits for
+    the next one, which starts when that call finishes and is shared by
+    everyone who arrived in the meantime, so a burst of callers costs at
+    most two calls.
+    """
+
+    def __init__(self, fn, window):
+        self.fn = fn
+        self.window = window
+        # (started_at, task) of the last call, while it may be shared
+        self._flight = None
+        # Task that makes the call after the one in flight
+        self._next = None
+        self.calls = 0
+        self.shared = 0
+
+    def _start(self):
+        self.calls += 1
+        task = asyncio.ensure_future(self.fn())
+        flight = self._flight = (time.monotonic(), task)
+        task.add_done_callback(lambda _: self._finish(flight))
+        return task
+
+    def _finish(self, flight):
+        task = flight[1]
+        if self._flight is flight and (self.window <= 0 or task.cancelled() or task.exception() is not None):
+            self._flight = None
+
+    async def _start_after(self, task):
+        waiting_since = time.monotonic()
+        await asyncio.wait([task])
+        self._next = None
+        # Someone who came in after that call finished may have started one.
+        # The call waited on, or any other that started before the wait,
+        # is too old for the callers waiting here.
+        flight = self._flight
+        if flight is not None and flight[1] is not task and flight[0] >= waiting_since:
+            self.shared += 1
+            return await flight[1]
+        return await self._start()
+
+    async def __call__(self):
+        flight = self._flight
+        if flight is not None and flight[1].done() and time.monotonic() - flight[0] > self.window:
+            flight = self._flight = None
+        if flight is None:
+            task = self._start()
+        else:
+            self.shared += 1
+            if time.monotonic() - flight[0] <= self.window:
+                task = flight[1]
+            else:
+                if self._next is None:
+                    self._next = asyncio.ensure_future(self._start_after(flight[1]))
+                task = self._next
+        # A caller that goes away doesn't cancel the call for the others
+        return await asyncio.shield(task)
+
+async def fetch_shard_counters():
+    """(value, processor) with the counters of every shard added up"""
+    reads = await asyncio.gather(*(run_in_manager_thread(shard.pool.call, fetch_counter) for shard in shards))
+    if len(reads) == 1:
+        return reads[0]
+    return sum(value for value, _ in reads), ", ".join(processor for _, processor in reads)
+
+# (fetched_at, value, processor) of the last counter read from the manager
+counter_cache = None
+
+async def read_worker_counter():
+    """Ask a worker on every shard for the counter, with the stage timing"""
+    if len(shards) == 1:
+        return await process_task("get", timing=True)
+    # Every shard has a counter of its own
+    results = await asyncio.gather(*(process_task("get", timing=True, shard=shard) for shard in shards))
+    result = dict(results[0])
+    result["counter"] = sum(r["counter"] for r in results)
+    result["processor"] = ", ".join(r["processor"] for r in results)
+    result["task_id"] = [r["task_id"] for r in results]
+    # The reads run side by side, so the slowest one is the request
+    result["timing"] = max((r["timing"] for r in results), key=lambda t: t["total"])
+    return result
+
+# Counter reads in flight, shared by the requests that arrive meanwhile
+manager_counter_reads = SingleFlight(fetch_shard_counters, COUNTER_COALESCE_WINDOW)
+worker_counter_reads = SingleFlight(read_worker_counter, COUNTER_COALESCE_WINDOW)
+
+metrics.gauge("mpf_api_counter_fetches_total", "Counter reads sent to the manager or the workers; concurrent requests share them",
+              lambda: manager_counter_reads.calls + worker_counter_reads.calls, type="counter")
+metrics.gauge("mpf_api_coalesced_counter_reads_total", "Counter reads that shared another request's fetch",
+              lambda: manager_counter_reads.shared + worker_counter_reads.shared, type="counter")
+
+async def read_counter(timing=False):
+    """Read the counter from the manager servers, or from the cache when
+    COUNTER_MAX_STALENESS allows, in the shape process_task returns"""
+    global counter_cache
+    received = time.monotonic()
+    cached = counter_cache
+    if cached is not None and received - cached[0] < COUNTER_MAX_STALENESS:
+        source = "cache"
+        _, value, processor = cached
+    else:
+        source = "manager"
+        try:
+            value, processor = await manager_counter_reads()
         except Exception as e:
-            debug_print(f"Error in result loop: {e}")
-            debug_print(traceback.format_exc())
-            
-        # Small sleep to prevent CPU spinning
-        time.sleep(0.1)
-        
-    # If we get here, we timed out
-    debug_print(f"Timed out waiting for result after {timeout}s")
-    raise HTTPException(status_code=504, detail="Task processing timed out")
+            log.exception("Error reading counter from manager: %s", e)
+            raise HTTPException(status_code=500, detail=f"Error reading counter: {str(e)}")
+        counter_cache = (time.monotonic(), value, processor)
+    counter_reads.inc(source)
+    responded = time.monotonic()
+    response = {
+        "counter": value,
+        "processor": processor,
+        "api_server": api_server,
+        # No task was run for this read
+        "task_id": None,
+    }
+    if timing:
+        # The manager round trip (or cache hit) is the whole request
+        ms = round((responded - received) * 1000, 3)
+        response["timing"] = {"read": ms, "total": ms}
+    return response
+
+async def get_counter_result(timing=False):
+    if COUNTER_READ_PATH != "worker":
+        return await read_counter(timing)
+    # The timing is that of the shared read
+    result = dict(await worker_counter_reads())
+    if not timing:
+        del result["timing"]
+    return result
 
 @app.get("/increment")
-def increment():
-    debug_print(f"increment endpoint called on {hostname}:{process_id}")
-    result = process_task("increment")
-    debug_print(f"increment returning result={result}")
+async def increment(response: Response, debug_timing: Optional[str] = Header(None, alias=TIMING_HEADER),
+                    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER)):
+    log.debug("increment endpoint called on %s:%s", hostname, process_id)
+    result = await run_endpoint_task("increment", response, debug_timing, idempotency_key)
+    log.debug("increment returning result=%s", result)
     return result
 
 @app.get("/decrement") 
-def decrement():
-    debug_print(f"decrement endpoint called on {hostname}:{process_id}")
-    result = process_task("decrement")
-    debug_print(f"decrement returning result={result}")
+async def decrement(response: Response, debug_timing: Optional[str] = Header(None, alias=TIMING_HEADER),
+                    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER)):
+    log.debug("decrement endpoint called on %s:%s", hostname, process_id)
+    result = await run_endpoint_task("decrement", response, debug_timing, idempotency_key)
+    log.debug("decrement returning result=%s", result)
     return result
 
 @app.get("/counter")
-def get_counter():
-    debug_print(f"counter endpoint called on {hostname}:{process_id}")
-    result = process_task("get")
-    debug_print(f"counter returning result={result}")
+async def get_counter(response: Response, debug_timing: Optional[str] = Header(None, alias=TIMING_HEADER)):
+    log.debug("counter endpoint called on %s:%s", hostname, process_id)
+    result = await get_counter_result(timing=bool(debug_timing))
+    if debug_timing:
+        response.headers["Server-Timing"] = server_timing(result["timing"])
+    log.debug("counter returning result=%s", result)
     return result
 
+def fetch_processor_info_string(conn):
+    # One round trip: the manager keeps the document pre-serialized
+    return conn.status_board.snapshot()
+
+async def fetch_processor_info():
+    """The processor info document; with several shards, their documents
+    combined, with each one's own under "shards"."""
+    json_strs = await asyncio.gather(*(run_in_manager_thread(shard.pool.call, fetch_processor_info_string) for shard in shards))
+    if len(json_strs) == 1:
+        return json_strs[0]
+    documents = [json.loads(json_str) for json_str in json_strs]
+    combined = {
+        # Each shard's server, in shard order
+        "server_hostname": ", ".join(str(document.get("server_hostname")) for document in documents),
+        "server_pid": [document.get("server_pid") for document in documents],
+        "counter_value": sum(document.get("counter_value", 0) for document in documents),
+        "num_workers": sum(document.get("num_workers", 0) for document in documents),
+        "worker_processes": [worker for document in documents for worker in document.get("worker_processes", [])],
+        "shard_routing": SHARD_ROUTING,
+        "shards": [dict(document, shard=shard.name) for shard, document in zip(shards, documents)],
+    }
+    return json.dumps(combined)
+
+# (fetched_at, info_dict) of the last good /processor-info document
+processor_info_cache = None
+
 @app.get("/processor-info")
-def get_processor_info():
-    debug_print(f"processor-info endpoint called on {hostname}:{process_id}")
+async def get_processor_info():
+    global processor_info_cache
+    log.debug("processor-info endpoint called on %s:%s", hostname, process_id)
     try:
-        # Get the manager
-        manager = get_manager()
-        
-        # Use the method that returns a simple string
-        try:
-            # Get the proxy object
-            proxy_obj = manager.get_processor_info_as_string()
-            debug_print(f"Got proxy object: {type(proxy_obj)}")
-            
-            # Convert proxy to string - this is the critical step
-            if hasattr(proxy_obj, '_getvalue'):
-                # If it has _getvalue method, use it
-                json_str = proxy_obj._getvalue()
-                debug_print(f"Got value using _getvalue(): {type(json_str)}")
-            else:
-                # Otherwise try direct string conversion
-                json_str = str(proxy_obj)
-                debug_print(f"Converted to string using str(): {type(json_str)}")
-            
-            # Make sure it's a valid JSON string
-            if not json_str.startswith('{') and not json_str.startswith('['):
-                debug_print(f"Warning: Not a valid JSON string: {json_str[:100]}")
-                # Create a simple fallback dictionary
-                info_dict = {
-                    "error": "Invalid JSON string from server",
-                    "raw_value": json_str[:100] + "..." if len(json_str) > 100 else json_str
-                }
-            else:
-                # Parse the JSON string
-                info_dict = json.loads(json_str)
-                debug_print(f"Successfully parsed JSON string into dictionary with {len(info_dict)} keys")
-        except Exception as e:
-            debug_print(f"Error getting or parsing processor info: {e}")
-            debug_print(traceback.format_exc())
-            info_dict = {"error": f"Could not get processor info: {str(e)}"}
+        cached = processor_info_cache
+        if cached is not None and time.monotonic() - cached[0] < PROCESSOR_INFO_MAX_STALENESS:
+            log.debug("Serving processor info from cache")
+            info_dict = dict(cached[1])
+        else:
+            try:
+                json_str = await fetch_processor_info()
+                
+                # Make sure it's a valid JSON string
+                if not json_str.startswith('{') and not json_str.startswith('['):
+                    log.warning("Not a valid JSON string: %s", json_str[:100])
+                    # Create a simple fallback dictionary
+                    info_dict = {
+                        "error": "Invalid JSON string from server",
+                        "raw_value": json_str[:100] + "..." if len(json_str) > 100 else json_str
+                    }
+                else:
+                    # Parse the JSON string
+                    info_dict = json.loads(json_str)
+                    log.debug("Successfully parsed JSON string into dictionary with %s keys", len(info_dict))
+                    processor_info_cache = (time.monotonic(), info_dict)
+                    info_dict = dict(info_dict)
+            except Exception as e:
+                log.exception("Error getting or parsing processor info: %s", e)
+                info_dict = {"error": f"Could not get processor info: {str(e)}"}
         
         # Add current API server info
         info_dict["current_api_server"] = f"{hostname}:{process_id}"
         
         return info_dict
     except Exception as e:
-        debug_print(f"Error in get_processor_info: {e}")
-        debug_print(traceback.format_exc())
+        log.exception("Error in get_processor_info: %s", e)
         raise HTTPException(status_code=500, detail=f"Error getting processor info: {str(e)}")
 
 @app.get("/counter-value")
-def get_counter_value():
+async def get_counter_value():
     """Simple endpoint that returns just the counter value as an integer"""
-    debug_print(f"counter-value endpoint called on {hostname}:{process_id}")
+    log.debug("counter-value endpoint called on %s:%s", hostname, process_id)
     try:
-        # Use the same process_task function that the /counter endpoint uses
-        # This ensures we get the actual counter value from a worker process
-        result = process_task("get")
+        # Same read path as the /counter endpoint
+        result = await get_counter_result()
         
         # Extract just the counter value
         counter_value = result.get("counter", 0)
-        debug_print(f"Got counter value: {counter_value}")
+        log.debug("Got counter value: %s", counter_value)
         
         # Return just the counter value in a simple format
         return {"counter": counter_value}
     except HTTPException as e:
         # If we got a timeout or other HTTP exception, return 0 with an error
-        debug_print(f"HTTP error in get_counter_value: {e.detail}")
+        log.warning("HTTP error in get_counter_value: %s", e.detail)
         return {"counter": 0, "error": e.detail}
     except Exception as e:
         # For any other error, also return 0 with the error message
-        debug_print(f"Error in get_counter_value: {e}")
-        debug_print(traceback.format_exc())
+        log.exception("Error in get_counter_value: %s", e)
         return {"counter": 0, "error": str(e)}
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """This API process's metrics in the Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
-    debug_print("Starting FastAPI server")
+    log.info("Starting FastAPI server on %s:%s with %s worker process(es)", API_HOST, API_PORT, API_WORKERS)
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    if API_WORKERS > 1:
+        from uvicorn.supervisors import Multiprocess
+        # uvicorn imports the app afresh in each worker process, so every
+        # one gets its own pid, api_server name, pool and router
+        config = uvicorn.Config("app:app", host=API_HOST, port=API_PORT, workers=API_WORKERS)
+        # What uvicorn.run does for workers > 1, except that we bind the
+        # socket: uvicorn leaves out IPPROTO_TCP, and asyncio only sets
+        # TCP_NODELAY on connections accepted from a socket that says it is
+        # TCP. Without it every response waits ~40 ms for a delayed ACK.
+        family = socket.AF_INET6 if ":" in API_HOST else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((API_HOST, API_PORT))
+        sock.set_inheritable(True)
+        Multiprocess(config, sockets=[sock]).run()
+    else:
+        uvicorn.run(app, host=API_HOST, port=API_PORT)
@@ -0,0 +1,85 @@
+import http.client
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+# Needs a running manager_server.py. Starts app.py with each number of
+# uvicorn worker processes in turn and drives it from CLIENTS processes,
+# each sending requests back to back on a keep-alive connection.
+API_WORKER_COUNTS = [1, 2, 4]
+CLIENTS = 16
+DURATION = 5.0
+# A port of its own so it can run next to an API server on 8000
+PORT = int(os.environ.get("BENCHMARK_API_PORT", "8100"))
+# /increment goes through the workers; /counter is a manager read
+ENDPOINT = sys.argv[1] if len(sys.argv) > 1 else "/increment"
+
+def client(start, out):
+    conn = http.client.HTTPConnection("127.0.0.1", PORT)
+    start.wait()
+    deadline = time.monotonic() + DURATION
+    latencies = []
+    errors = 0
+    while time.monotonic() < deadline:
+        began = time.perf_counter()
+        conn.request("GET", ENDPOINT)
+        response = conn.getresponse()
+        response.read()
+        if response.status == 200:
+            latencies.append(time.perf_counter() - began)
+        else:
+            errors += 1
+    out.put((latencies, errors))
+
+def wait_until_serving(timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", PORT, timeout=1)
+            conn.request("GET", "/metrics")
+            conn.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"API server did not start on port {PORT}")
+
+def run(api_workers):
+    env = dict(os.environ, API_PORT=str(PORT), API_WORKERS=str(api_workers), LOG_LEVEL="WARNING")
+    server = subprocess.Popen([sys.executable, "app.py"], env=env)
+    try:
+        wait_until_serving()
+        # Let every uvicorn worker finish opening its manager pool
+        time.sleep(1 + api_workers)
+        start = multiprocessing.Event()
+        out = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target=client, args=(start, out)) for _ in range(CLIENTS)]
+        for c in clients:
+            c.start()
+        start.set()
+        latencies = []
+        errors = 0
+        for _ in clients:
+            client_latencies, client_errors = out.get()
+            latencies.extend(client_latencies)
+            errors += client_errors
+        for c in clients:
+            c.join()
+    finally:
+        server.terminate()
+        server.wait()
+    latencies.sort()
+    return {
+        "rate": len(latencies) / DURATION,
+        "p50": latencies[len(latencies) // 2] * 1000,
+        "p99": latencies[int(len(latencies) * 0.99)] * 1000,
+        "errors": errors,
+    }
+
+if __name__ == "__main__":
+    print(f"GET {ENDPOINT} from {CLIENTS} clients for {DURATION:.0f}s each run ({os.cpu_count()} CPUs)")
+    print(f"{'API workers':<12} {'req/sec':>10} {'p50 ms':>10} {'p99 ms':>10} {'errors':>8}")
+    for api_workers in API_WORKER_COUNTS:
+        result = run(api_workers)
+        print(f"{api_workers:<12} {result['rate']:>10,.0f} {result['p50']:>10.2f} {result['p99']:>10.2f} {result['errors']:>8}")
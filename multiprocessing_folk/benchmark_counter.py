@@ -0,0 +1,51 @@
+import multiprocessing
+import time
+
+from counter_backends import LockedCounter, ShardedCounter
+
+# How long each run keeps incrementing
+DURATION = 2.0
+WORKER_COUNTS = [1, 2, 4, 8, 16]
+
+def increment_worker(counter, worker_id, start, done_counts):
+    """Increment as fast as possible for DURATION seconds after start is set"""
+    counter.bind_worker(worker_id)
+    start.wait()
+    deadline = time.monotonic() + DURATION
+    count = 0
+    while time.monotonic() < deadline:
+        counter.increment()
+        count += 1
+    done_counts[worker_id] = count
+
+def run(make_counter, num_workers):
+    counter = make_counter(num_workers)
+    start = multiprocessing.Event()
+    done_counts = multiprocessing.Array('q', num_workers)
+
+    processes = [
+        multiprocessing.Process(target=increment_worker, args=(counter, i, start, done_counts))
+        for i in range(num_workers)
+    ]
+    for p in processes:
+        p.start()
+    start.set()
+    for p in processes:
+        p.join()
+
+    total = sum(done_counts)
+    # Every increment has to be visible once the writers are done
+    assert counter.get() == total, f"Lost increments: counter={counter.get()}, expected {total}"
+    return total / DURATION
+
+if __name__ == "__main__":
+    backends = {
+        "locked": lambda num_workers: LockedCounter(),
+        "sharded": lambda num_workers: ShardedCounter(num_workers),
+    }
+
+    print(f"Increment throughput over {DURATION:.0f}s runs (increments/sec)")
+    print(f"{'workers':>8} " + " ".join(f"{name:>12}" for name in backends))
+    for num_workers in WORKER_COUNTS:
+        rates = [run(make, num_workers) for make in backends.values()]
+        print(f"{num_workers:>8} " + " ".join(f"{rate:>12,.0f}" for rate in rates))
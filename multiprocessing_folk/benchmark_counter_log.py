@@ -0,0 +1,124 @@
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from counter_backends import LockedCounter
+from counter_log import CounterLog, RECORD, INCREMENT
+
+# How long each throughput run keeps incrementing
+DURATION = 2.0
+WORKER_COUNTS = [1, 4, 16]
+# Records in the log for each recovery run
+LOG_SIZES = [10000, 100000, 1000000]
+
+class InMemory:
+    """No log at all, for comparison"""
+
+    def record_increment(self, count):
+        pass
+
+    def fsyncs(self):
+        return 0
+
+class FsyncEach:
+    """What the log costs without group commit: an fsync per increment"""
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, "fsync-each.log")
+        self._fsyncs = multiprocessing.Value('q', 0)
+        self._fd = None
+
+    def record_increment(self, count):
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.write(self._fd, RECORD.pack(INCREMENT, count, os.getpid()))
+        os.fdatasync(self._fd)
+        with self._fsyncs.get_lock():
+            self._fsyncs.value += 1
+
+    def fsyncs(self):
+        return self._fsyncs.value
+
+def increment_worker(counter, counter_log, worker_id, start, done_counts):
+    """Increment, logging each increment, for DURATION seconds after start is set"""
+    start.wait()
+    deadline = time.monotonic() + DURATION
+    count = 0
+    while time.monotonic() < deadline:
+        counter.increment()
+        counter_log.record_increment(1)
+        count += 1
+    done_counts[worker_id] = count
+
+def run(make_log, num_workers, directory):
+    counter = LockedCounter()
+    counter_log = make_log(directory)
+    start = multiprocessing.Event()
+    done_counts = multiprocessing.Array('q', num_workers)
+
+    processes = [
+        multiprocessing.Process(target=increment_worker, args=(counter, counter_log, i, start, done_counts))
+        for i in range(num_workers)
+    ]
+    for p in processes:
+        p.start()
+    start.set()
+    for p in processes:
+        p.join()
+    total = sum(done_counts)
+    return total / DURATION, total / max(counter_log.fsyncs(), 1)
+
+def write_log(directory, records):
+    """A log of records increments, as the workers would have left it"""
+    with open(os.path.join(directory, "counter-00000000.log"), "wb") as f:
+        f.write(RECORD.pack(INCREMENT, 1, os.getpid()) * records)
+
+def recover(directory, records):
+    started = time.perf_counter()
+    state = CounterLog(directory).state
+    seconds = time.perf_counter() - started
+    assert state["value"] == records and state["records"] == records, state
+    return seconds
+
+if __name__ == "__main__":
+    # fsync only means something on a real disk, so pass a directory on
+    # the disk the manager would log to; the default is under this one
+    base = tempfile.mkdtemp(prefix="benchmark-counter-log-", dir=sys.argv[1] if len(sys.argv) > 1 else ".")
+    modes = {
+        "in memory": lambda directory: InMemory(),
+        "fsync each": FsyncEach,
+        "group 0ms": lambda directory: CounterLog(directory, window=0),
+        "group 2ms": lambda directory: CounterLog(directory, window=0.002),
+    }
+    try:
+        print(f"Increment throughput over {DURATION:.0f}s runs (increments/sec, and increments per fsync)")
+        print(f"{'workers':>8} " + " ".join(f"{name:>18}" for name in modes))
+        for num_workers in WORKER_COUNTS:
+            results = []
+            for n, make_log in enumerate(modes.values()):
+                directory = os.path.join(base, f"run-{num_workers}-{n}")
+                os.makedirs(directory)
+                results.append(run(make_log, num_workers, directory))
+            print(f"{num_workers:>8} " + " ".join(
+                f"{rate:>11,.0f} ({per_fsync:>4.1f})" if name != "in memory" else f"{rate:>18,.0f}"
+                for name, (rate, per_fsync) in zip(modes, results)))
+        print()
+
+        print("Recovery time by log size (seconds)")
+        print(f"{'records':>10} {'log MB':>8} {'replay':>8} {'snapshot':>9}")
+        for records in LOG_SIZES:
+            directory = os.path.join(base, f"recover-{records}")
+            os.makedirs(directory)
+            write_log(directory, records)
+            replay = recover(directory, records)
+            # Once a snapshot has folded the log away there is nothing to replay
+            CounterLog(directory).snapshot()
+            started = time.perf_counter()
+            assert CounterLog(directory).state["value"] == records
+            snapshot = time.perf_counter() - started
+            print(f"{records:>10,} {records * RECORD.size / 1e6:>8.1f} {replay:>8.3f} {snapshot:>9.4f}")
+    finally:
+        shutil.rmtree(base)
@@ -0,0 +1,101 @@
+import multiprocessing
+import time
+import uuid
+from multiprocessing.managers import SyncManager
+
+from shm_ring import ShmRing
+
+# Messages per throughput run, and per latency run (sent with a small gap
+# so we measure transport latency rather than queueing behind a backlog)
+THROUGHPUT_MESSAGES = 20000
+LATENCY_MESSAGES = 2000
+LATENCY_GAP = 0.0005
+
+class QueueManager(SyncManager):
+    pass
+
+class EndpointManager(SyncManager):
+    pass
+
+def make_message():
+    return (str(uuid.uuid4()), "increment", "bench-host:12345", time.perf_counter())
+
+def producer(connect, count, gap, start):
+    q = connect()
+    start.wait()
+    for _ in range(count):
+        q.put(make_message())
+        if gap:
+            time.sleep(gap)
+
+def consumer(connect, count, out):
+    q = connect()
+    latencies = []
+    for _ in range(count):
+        message = q.get()
+        latencies.append(time.perf_counter() - message[3])
+    out.put((time.perf_counter(), latencies))
+
+def run(connect_producer, connect_consumer, count, gap):
+    start = multiprocessing.Event()
+    out = multiprocessing.Queue()
+    c = multiprocessing.Process(target=consumer, args=(connect_consumer, count, out))
+    p = multiprocessing.Process(target=producer, args=(connect_producer, count, gap, start))
+    c.start()
+    p.start()
+    time.sleep(0.5)
+    began = time.perf_counter()
+    start.set()
+    finished, latencies = out.get()
+    p.join()
+    c.join()
+    latencies.sort()
+    return {
+        "rate": count / (finished - began),
+        "p50": latencies[len(latencies) // 2] * 1000,
+        "p99": latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+def report(name, throughput, latency):
+    print(f"{name:<28} {throughput['rate']:>12,.0f} {latency['p50']:>10.3f} {latency['p99']:>10.3f}")
+
+if __name__ == "__main__":
+    # The manager_server layout: a SyncManager owns the queue and a second
+    # manager endpoint hands out proxies to it, so clients go through two hops
+    queue_manager = QueueManager()
+    queue_manager.start()
+    shared_queue = queue_manager.Queue()
+    EndpointManager.register('get_queue', callable=lambda: shared_queue)
+    endpoint = EndpointManager(address=('127.0.0.1', 0), authkey=b'bench')
+    endpoint.start()
+    endpoint_address = endpoint.address
+
+    def via_endpoint():
+        m = EndpointManager(address=endpoint_address, authkey=b'bench')
+        m.connect()
+        return m.get_queue()
+
+    def direct_proxy():
+        return shared_queue
+
+    ring = ShmRing("mpf_bench", slots=4096, create=True)
+
+    def shm_ring():
+        # Forked children reuse the mapping and open their own descriptors
+        return ring
+
+    print(f"{'transport':<28} {'msgs/sec':>12} {'p50 ms':>10} {'p99 ms':>10}")
+    try:
+        report("manager endpoint (2 hops)",
+               run(via_endpoint, direct_proxy, THROUGHPUT_MESSAGES, 0),
+               run(via_endpoint, direct_proxy, LATENCY_MESSAGES, LATENCY_GAP))
+        report("manager queue proxy (1 hop)",
+               run(direct_proxy, direct_proxy, THROUGHPUT_MESSAGES, 0),
+               run(direct_proxy, direct_proxy, LATENCY_MESSAGES, LATENCY_GAP))
+        report("shared-memory ring",
+               run(shm_ring, shm_ring, THROUGHPUT_MESSAGES, 0),
+               run(shm_ring, shm_ring, LATENCY_MESSAGES, LATENCY_GAP))
+    finally:
+        ring.unlink()
+        endpoint.shutdown()
+        queue_manager.shutdown()
@@ -0,0 +1,79 @@
+import itertools
+import multiprocessing
+import pickle
+import time
+import timeit
+import uuid
+
+import wire
+from shm_ring import ShmRing
+
+# Calls per encode/decode timing, and messages per ring run
+CODEC_CALLS = 200000
+RING_MESSAGES = 50000
+BATCH_SIZE = 16
+
+task_ids = itertools.count(1 << 40)
+
+def task(compact):
+    task_id = next(task_ids) if compact else str(uuid.uuid4())
+    return (task_id, "increment", "bench-host:12345", time.monotonic(), time.time() + 10)
+
+def result(compact):
+    task_id = next(task_ids) if compact else str(uuid.uuid4())
+    now = time.monotonic()
+    return (task_id, 42, "bench-host:23456", {"picked_up": now, "lock_wait": 0.00001, "completed": now + 0.0001})
+
+# (name, message factory); pickle runs use UUID task ids as app.py does
+MESSAGES = [
+    ("task", task),
+    ("result", result),
+    (f"batch of {BATCH_SIZE} tasks", lambda compact: [task(compact) for _ in range(BATCH_SIZE)]),
+    (f"batch of {BATCH_SIZE} results", lambda compact: [result(compact) for _ in range(BATCH_SIZE)]),
+]
+
+def per_call_us(fn):
+    return timeit.timeit(fn, number=CODEC_CALLS) / CODEC_CALLS * 1e6
+
+def codec_row(name, make):
+    pickled_message = make(False)
+    compact_message = make(True)
+    pickled = wire.pickle_dumps(pickled_message)
+    compact = wire.dumps(compact_message)
+    assert wire.loads(compact) == compact_message
+    print(f"{name:<22} {len(pickled):>8} {len(compact):>8}"
+          f" {per_call_us(lambda: wire.pickle_dumps(pickled_message)):>9.2f} {per_call_us(lambda: wire.dumps(compact_message)):>9.2f}"
+          f" {per_call_us(lambda: pickle.loads(pickled)):>9.2f} {per_call_us(lambda: wire.loads(compact)):>9.2f}")
+
+def producer(ring, compact, start):
+    messages = [task(compact) for _ in range(RING_MESSAGES)]
+    start.wait()
+    for message in messages:
+        ring.put(message)
+
+def ring_rate(compact):
+    ring = ShmRing("mpf_bench_wire", slots=4096, create=True, dumps=wire.dumps if compact else wire.pickle_dumps)
+    try:
+        start = multiprocessing.Event()
+        p = multiprocessing.Process(target=producer, args=(ring, compact, start))
+        p.start()
+        time.sleep(0.5)
+        began = time.perf_counter()
+        start.set()
+        for _ in range(RING_MESSAGES):
+            ring.get()
+        rate = RING_MESSAGES / (time.perf_counter() - began)
+        p.join()
+        return rate
+    finally:
+        ring.unlink()
+
+if __name__ == "__main__":
+    print("Bytes per message, and microseconds per encode and decode (pickle with UUID task ids vs compact)")
+    print(f"{'message':<22} {'pickle B':>8} {'compact B':>8} {'pickle enc':>9} {'compact enc':>9} {'pickle dec':>9} {'compact dec':>9}")
+    for name, make in MESSAGES:
+        codec_row(name, make)
+    print()
+    print("Tasks through a shared-memory ring, one producer and one consumer process")
+    for name, compact in (("pickle", False), ("compact", True)):
+        print(f"{name:<22} {ring_rate(compact):>12,.0f} msgs/sec")
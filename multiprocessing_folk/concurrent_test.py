@@ -2,10 +2,11 @@ import requests
 import time
 import concurrent.futures
 import json
+import os
 from datetime import datetime
 
 # Base URL for the API
-BASE_URL = "http://localhost:8000"
+BASE_URL = os.environ.get("API_URL", "http://localhost:8000")
 
 def timestamp():
     """Return current timestamp for logging"""
@@ -0,0 +1,118 @@
+import multiprocessing
+import time
+
+# Each shard gets its own 64-byte cache line so workers don't false-share
+SHARD_STRIDE = 8
+
+class TimedLock:
+    """A lock that adds the time spent waiting for it to wait_seconds.
+
+    Each process gets its own copy of the total when it forks, so a worker
+    can read how long its own counter operations waited.
+    """
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.wait_seconds = 0.0
+
+    def __enter__(self):
+        started = time.monotonic()
+        self.lock.acquire()
+        self.wait_seconds += time.monotonic() - started
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+class LockedCounter:
+    """A single shared integer behind a lock, so every read sees every write"""
+
+    name = "locked"
+
+    def __init__(self, initial=0):
+        self._value = multiprocessing.Value('i', initial)
+        self._lock = TimedLock(self._value.get_lock())
+
+    @property
+    def lock_wait(self):
+        """Seconds this process has spent waiting for the counter lock"""
+        return self._lock.wait_seconds
+
+    def bind_worker(self, worker_id):
+        pass
+
+    def get(self):
+        with self._lock:
+            return self._value.value
+
+    def increment(self, count=1):
+        with self._lock:
+            self._value.value += count
+            return self._value.value
+
+    def decrement(self):
+        """Decrement unless the counter is already 0. Returns (decremented, value)"""
+        with self._lock:
+            if self._value.value <= 0:
+                return False, self._value.value
+            self._value.value -= 1
+            return True, self._value.value
+
+class ShardedCounter:
+    """One shared-memory slot per worker, each written only by its owner.
+
+    Increments touch no lock at all. Reads sum the slots without a lock,
+    so under concurrent updates they are approximate: a read can count a
+    decrement in one slot and miss the increment in another that came
+    before it, and return a value the counter never had. Reads are
+    clamped at 0, which the counter never goes below. Decrements take a
+    lock between themselves so two of them can't take it below 0.
+    """
+
+    name = "sharded"
+
+    def __init__(self, num_shards, initial=0):
+        self.num_shards = num_shards
+        self._slots = multiprocessing.Array('q', num_shards * SHARD_STRIDE, lock=False)
+        self._slots[0] = initial
+        self._decrement_lock = TimedLock(multiprocessing.Lock())
+        self._slot = None
+
+    @property
+    def lock_wait(self):
+        """Seconds this process has spent waiting for the decrement lock"""
+        return self._decrement_lock.wait_seconds
+
+    def bind_worker(self, worker_id):
+        """Claim the slot this process writes to. Call once in each worker."""
+        self._slot = (worker_id % self.num_shards) * SHARD_STRIDE
+
+    def _own_slot(self):
+        if self._slot is None:
+            raise RuntimeError("ShardedCounter used for writes before bind_worker()")
+        return self._slot
+
+    def get(self):
+        return max(sum(self._slots[::SHARD_STRIDE]), 0)
+
+    def increment(self, count=1):
+        slot = self._own_slot()
+        self._slots[slot] += count
+        return self.get()
+
+    def decrement(self):
+        """Decrement unless the counter is already 0. Returns (decremented, value)"""
+        slot = self._own_slot()
+        # Increments can only raise the total while we hold this lock, so
+        # the check below stays true until our write lands
+        with self._decrement_lock:
+            if self.get() <= 0:
+                return False, self.get()
+            self._slots[slot] -= 1
+            return True, self.get()
+
+def make_counter(backend, num_shards, initial=0):
+    if backend == "locked":
+        return LockedCounter(initial)
+    if backend == "sharded":
+        return ShardedCounter(num_shards, initial)
+    raise ValueError(f"Unknown counter backend: {backend!r} (expected 'locked' or 'sharded')")
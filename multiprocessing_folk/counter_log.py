@@ -0,0 +1,252 @@
+import json
+import multiprocessing
+import os
+import socket
+import struct
+import threading
+import time
+
+# kind, count, pid of the worker that made the change
+RECORD = struct.Struct("<BqI")
+# Kinds sit well away from 0, so the zeroed bytes a crash can leave at the
+# end of a segment don't read as records
+INCREMENT, DECREMENT = 0xA1, 0xA2
+
+# Log positions are segment << OFFSET_BITS | offset, so a position in a
+# later segment always compares greater
+OFFSET_BITS = 40
+
+SNAPSHOT = "snapshot.json"
+SEGMENT_PREFIX = "counter-"
+SEGMENT_SUFFIX = ".log"
+
+hostname = socket.gethostname()
+
+def _fsync_dir(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _caller(pid):
+    return f"{hostname}:{pid}"
+
+class CounterLog:
+    """Write-ahead log of counter changes, so the counter survives a restart.
+
+    Workers append one fixed-size record per counter update (a batch of
+    increments is one record) and don't reply until it is on disk. fsyncs
+    are group-committed: a worker waits `window` seconds for others to
+    append before it asks for one, then the first to take the sync lock
+    fsyncs every record written so far, and the workers queued behind it
+    find their records already durable.
+
+    The log is a series of segment files. snapshot() moves appends to a
+    new segment, folds the finished ones into snapshot.json and deletes
+    them, so a restart loads the snapshot and replays only what came after
+    it. Create the log before forking the workers; they share its locks
+    and positions.
+    """
+
+    def __init__(self, directory, window=0.002):
+        self.directory = directory
+        self.window = window
+        os.makedirs(directory, exist_ok=True)
+        # The segment appends go to, and the position up to which the log
+        # is known to be on disk
+        self._segment = multiprocessing.Value('q', 0, lock=False)
+        self._durable = multiprocessing.Value('q', 0, lock=False)
+        # Appends hold the first only while they write. fsyncs and segment
+        # switches hold the second, and take the first too if they need both.
+        self._append_lock = multiprocessing.Lock()
+        self._sync_lock = multiprocessing.Lock()
+        self._appends = multiprocessing.Value('q', 0, lock=False)
+        self._fsyncs = multiprocessing.Value('q', 0, lock=False)
+        self.snapshots = 0
+        self._snapshot_lock = threading.Lock()
+        # (pid, segment, fd) of the segment this process has open
+        self._file = None
+        self.state = self._recover()
+
+    def _path(self, segment):
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{segment:08d}{SEGMENT_SUFFIX}")
+
+    def _segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                segments.append(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+        return sorted(segments)
+
+    def _load_snapshot(self):
+        try:
+            with open(os.path.join(self.directory, SNAPSHOT)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"value": 0, "last_increment": None, "last_decrement": None, "segment": 0}
+
+    def _replay(self, state, segment):
+        """Apply a segment's records to state, returning how many bytes of it are whole records"""
+        with open(self._path(segment), "rb") as f:
+            data = f.read()
+        data = data[:len(data) - len(data) % RECORD.size]
+        value = state["value"]
+        last_increment = last_decrement = None
+        valid = 0
+        for kind, count, pid in RECORD.iter_unpack(data):
+            if kind == INCREMENT:
+                value += count
+                last_increment = pid
+            elif kind == DECREMENT:
+                value -= count
+                last_decrement = pid
+            else:
+                break
+            valid += RECORD.size
+        state["value"] = value
+        state["records"] = state.get("records", 0) + valid // RECORD.size
+        if last_increment is not None:
+            state["last_increment"] = _caller(last_increment)
+        if last_decrement is not None:
+            state["last_decrement"] = _caller(last_decrement)
+        return valid
+
+    def _create_segment(self, segment):
+        os.close(os.open(self._path(segment), os.O_WRONLY | os.O_CREAT, 0o644))
+        _fsync_dir(self.directory)
+
+    def _recover(self):
+        """Load the snapshot and replay the segments after it.
+
+        Returns {"value", "last_increment", "last_decrement", "records",
+        "seconds"}: the recovered state, how many records were replayed
+        and how long it took.
+        """
+        started = time.monotonic()
+        state = self._load_snapshot()
+        snapshot_segment = state.pop("segment")
+        state["records"] = 0
+        segments = self._segments()
+        for segment in segments:
+            # Left behind by a snapshot that stopped before deleting them
+            if segment < snapshot_segment:
+                os.remove(self._path(segment))
+        segments = [segment for segment in segments if segment >= snapshot_segment]
+        valid = 0
+        for segment in segments:
+            valid = self._replay(state, segment)
+        if segments:
+            current = segments[-1]
+            # Drop a record torn by a crash, so new ones follow the last whole one
+            if os.path.getsize(self._path(current)) != valid:
+                os.truncate(self._path(current), valid)
+        else:
+            current = snapshot_segment
+            self._create_segment(current)
+            valid = 0
+        self._segment.value = current
+        self._durable.value = current << OFFSET_BITS | valid
+        state["seconds"] = time.monotonic() - started
+        return state
+
+    def _open(self):
+        segment = self._segment.value
+        pid = os.getpid()
+        if self._file is None or self._file[:2] != (pid, segment):
+            if self._file is not None and self._file[0] == pid:
+                os.close(self._file[2])
+            fd = os.open(self._path(segment), os.O_WRONLY | os.O_APPEND)
+            self._file = (pid, segment, fd)
+        return self._file
+
+    def _append(self, kind, count):
+        record = RECORD.pack(kind, count, os.getpid())
+        with self._append_lock:
+            _, segment, fd = self._open()
+            os.write(fd, record)
+            end = os.lseek(fd, 0, os.SEEK_CUR)
+            self._appends.value += 1
+        position = segment << OFFSET_BITS | end
+        # One 64-bit word, so it reads whole without the lock
+        if self.window and self._durable.value < position:
+            time.sleep(self.window)
+        if self._durable.value >= position:
+            return
+        with self._sync_lock:
+            # Whoever held the lock before us may have synced our record
+            if self._durable.value >= position:
+                return
+            size = os.fstat(fd).st_size
+            os.fdatasync(fd)
+            self._fsyncs.value += 1
+            # Segments only switch under this lock, after syncing the old
+            # one, so our segment is still the one being appended to
+            self._durable.value = segment << OFFSET_BITS | size
+
+    def record_increment(self, count):
+        """Log an increment by count; returns once it is on disk"""
+        self._append(INCREMENT, count)
+
+    def record_decrement(self):
+        """Log a decrement by 1; returns once it is on disk"""
+        self._append(DECREMENT, 1)
+
+    def snapshot(self):
+        """Fold every finished segment into snapshot.json and delete them.
+
+        Call it from one process only (the manager's main process).
+        Returns False if nothing was logged since the last snapshot.
+        """
+        with self._snapshot_lock:
+            return self._snapshot()
+
+    def _snapshot(self):
+        with self._sync_lock:
+            old = self._segment.value
+            if os.path.getsize(self._path(old)) == 0:
+                return False
+            new = old + 1
+            self._create_segment(new)
+            with self._append_lock:
+                self._segment.value = new
+            # Appends to the old segment have all finished; make them durable
+            # before anyone waiting on them is told so
+            fd = os.open(self._path(old), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self._durable.value = new << OFFSET_BITS
+
+        state = self._load_snapshot()
+        for segment in self._segments():
+            if state["segment"] <= segment < new:
+                self._replay(state, segment)
+        state.pop("records", None)
+        state["segment"] = new
+        path = os.path.join(self.directory, SNAPSHOT)
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        _fsync_dir(self.directory)
+        for segment in self._segments():
+            if segment < new:
+                os.remove(self._path(segment))
+        self.snapshots += 1
+        return True
+
+    def appends(self):
+        return self._appends.value
+
+    def fsyncs(self):
+        return self._fsyncs.value
+
+    def log_bytes(self):
+        """Bytes in the segment being appended to"""
+        try:
+            return os.path.getsize(self._path(self._segment.value))
+        except FileNotFoundError:
+            return 0
@@ -0,0 +1,38 @@
+import bisect
+import hashlib
+
+def _hash(key):
+    # Stable across processes and hosts, unlike hash() on a str
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+class HashRing:
+    """Consistent hashing of keys onto nodes.
+
+    Each node gets `replicas` points on the ring and a key goes to the node
+    of the first point after its hash, so keys spread evenly and adding or
+    removing a node only moves the keys next to its points. Nodes are
+    placed by their name, so every API process maps a key the same way.
+    """
+
+    def __init__(self, nodes, name=str, replicas=100):
+        points = sorted(
+            (_hash(f"{name(node)}#{replica}"), index)
+            for index, node in enumerate(nodes)
+            for replica in range(replicas)
+        )
+        self.nodes = list(nodes)
+        self._hashes = [point for point, _ in points]
+        self._indexes = [index for _, index in points]
+
+    def node_for(self, key, usable=None):
+        """The node key maps to. With usable, the first node from there on
+        round the ring that usable accepts, so a key whose node is out of
+        service moves to the next one; if none is usable, the key's own."""
+        start = bisect.bisect(self._hashes, _hash(key))
+        points = len(self._hashes)
+        if usable is not None:
+            for i in range(start, start + points):
+                node = self.nodes[self._indexes[i % points]]
+                if usable(node):
+                    return node
+        return self.nodes[self._indexes[start % points]]
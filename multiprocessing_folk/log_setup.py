@@ -0,0 +1,82 @@
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+from multiprocessing import util
+
+# DEBUG, INFO, WARNING or ERROR. Per-task tracing is logged at DEBUG.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# Fraction of DEBUG records that are kept, so tracing can stay on under load
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "1"))
+
+LOG_FORMAT = "[%(name)s %(levelname)s] %(asctime)s - %(message)s"
+LOG_DATE_FORMAT = "%H:%M:%S"
+
+_configure_lock = threading.Lock()
+_queue_handler = None
+_stream_handler = None
+
+class SampleFilter(logging.Filter):
+    """Keep only a random fraction of records at or below DEBUG"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue records as they are; the listener thread formats them.
+
+    The stock QueueHandler copies and formats every record on the calling
+    thread so it can cross a process boundary. Ours never leaves the
+    process, so all of that can wait for the listener.
+    """
+
+    def prepare(self, record):
+        return record
+
+def _start_listener():
+    # Records are queued by the calling thread and written to stdout by a
+    # listener thread, so a request never waits on a terminal or pipe.
+    # Each process needs its own queue and thread; neither survives a fork.
+    log_queue = queue.SimpleQueue()
+    _queue_handler.queue = log_queue
+    listener = logging.handlers.QueueListener(log_queue, _stream_handler, respect_handler_level=True)
+    listener.start()
+    # Flush what is still queued when the process exits, workers included
+    util.Finalize(None, listener.stop, exitpriority=-100)
+
+def _configure():
+    global _queue_handler, _stream_handler
+    with _configure_lock:
+        if _queue_handler is not None:
+            return
+        _stream_handler = logging.StreamHandler(sys.stdout)
+        _stream_handler.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT))
+        _queue_handler = DeferredQueueHandler(None)
+        if LOG_SAMPLE_RATE < 1:
+            _queue_handler.addFilter(SampleFilter(LOG_SAMPLE_RATE))
+        # Skip per-record lookups the format above never shows
+        logging.logThreads = False
+        logging.logProcesses = False
+        logging.logMultiprocessing = False
+        logging._srcfile = None
+        root = logging.getLogger()
+        root.addHandler(_queue_handler)
+        root.setLevel(LOG_LEVEL)
+        _start_listener()
+        util.register_after_fork(_queue_handler, lambda handler: _start_listener())
+
+def get_logger(name):
+    """Return a logger whose records go through the shared queued handler.
+
+    Pass arguments separately (log.debug("got %s", task)) rather than as an
+    f-string: a disabled level then costs one comparison and no formatting.
+    """
+    _configure()
+    return logging.getLogger(name)
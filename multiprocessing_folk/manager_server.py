@@ -3,54 +3,276 @@ import multiprocessing
 import time
 import os
 import sys
-import traceback
 import socket
 import queue
 import json
+import threading
+import signal
+import itertools
+import logging
+import http.server
+import multiprocessing.connection
+import ctypes
 
-# Set up debug printing
-def debug_print(message):
-    print(f"[DEBUG] {time.strftime('%H:%M:%S')} - {message}", flush=True)
+from counter_backends import make_counter
+from counter_log import CounterLog
+from task_tracker import TaskTracker
+from result_cache import ResultCache
+from task_scheduler import TaskScheduler, RingLaneReader, lane_for
+from shm_ring import ShmRing
+import wire
+from log_setup import get_logger
+from metrics import Registry, WorkerStats, WorkerHistogram
+
+# Leveled, queued logging (see log_setup.py); LOG_LEVEL=DEBUG traces every task
+log = get_logger("manager_server")
 
 # Get hostname for processor identification
 hostname = socket.gethostname()
 process_id = os.getpid()
-debug_print(f"Starting manager_server.py on {hostname} with PID {process_id}")
+log.info("Starting manager_server.py on %s with PID %s", hostname, process_id)
+
+# Where the manager server listens. Set MANAGER_HOST=0.0.0.0 to serve API
+# servers on other hosts; they must use the same MANAGER_AUTHKEY.
+MANAGER_HOST = os.environ.get("MANAGER_HOST", "127.0.0.1")
+MANAGER_PORT = int(os.environ.get("MANAGER_PORT", "50000"))
+MANAGER_AUTHKEY = os.environ.get("MANAGER_AUTHKEY", "secret").encode()
+
+def ignore_stop_signals():
+    """Ctrl-C and SIGTERM reach the whole process group; the main process
+    decides when the workers and manager servers stop, and tells them"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+# prctl(2) option that has the kernel send a process a signal when its
+# parent exits
+PR_SET_PDEATHSIG = 1
+
+def exit_with_parent():
+    """Exit when the main process does, however it dies. Children ignore
+    Ctrl-C and SIGTERM, so without this one whose main process was killed
+    would keep running, and an orphaned manager server keeps its port."""
+    if sys.platform.startswith("linux"):
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.prctl(PR_SET_PDEATHSIG, signal.SIGKILL) != 0:
+            log.warning("Can't ask to exit with the main process: %s", os.strerror(ctypes.get_errno()))
+    else:
+        def watch_parent():
+            while os.getppid() == process_id:
+                time.sleep(1)
+            os._exit(1)
+        threading.Thread(target=watch_parent, name="parent-watcher", daemon=True).start()
+    # The main process may have died before we asked
+    if os.getppid() != process_id:
+        os._exit(1)
+
+def init_child_process():
+    """Set up a manager server process forked from the main process"""
+    ignore_stop_signals()
+    exit_with_parent()
+
+class StateManager(SyncManager):
+    pass
+
+# Bounded task bookkeeping lives in the manager process behind a proxy
+StateManager.register('TaskTracker', TaskTracker)
+# So does the task scheduler that takes the place of a single task queue
+StateManager.register('TaskScheduler', TaskScheduler)
+# And the results kept for requests retried with the same idempotency key
+StateManager.register('ResultCache', ResultCache)
+
+# Tasks wait in lanes so a flood of slow decrements can't hold up cheap
+# gets and increments. Workers take from the lanes they serve by weighted
+# round-robin (see task_scheduler.py).
+TASK_LANES = {"increment": "fast", "get": "fast", "decrement": "slow"}
+# Task types not listed above cost an unknown amount, so treat them as slow
+DEFAULT_LANE = "slow"
+LANE_WEIGHTS = {
+    "fast": int(os.environ.get("FAST_LANE_WEIGHT", "4")),
+    "slow": int(os.environ.get("SLOW_LANE_WEIGHT", "1")),
+}
+# Every worker serves the fast lane, so stop messages go there on the rings
+CONTROL_LANE = "fast"
+# The fast-lane-only workers (see FAST_LANE_WORKERS) don't serve this lane,
+# so the stop that retires a worker at scale-down goes here and never
+# takes one of them
+RETIRE_LANE = DEFAULT_LANE
+# Most tasks a lane holds; a full lane refuses puts with queue.Full so API
+# servers can turn requests away instead of queueing them to time out
+TASK_QUEUE_MAX_DEPTH = int(os.environ.get("TASK_QUEUE_MAX_DEPTH", "1000"))
+# Workers ask the scheduler whether tasks in these lanes were cancelled
+# before running them; next to a slow task the round trip costs little
+CANCEL_CHECK_LANES = ("slow",)
 
 # Create a manager to share objects between processes
-manager = multiprocessing.Manager()
+manager = StateManager()
+manager.start(init_child_process)
 # Create shared queues using the manager
-task_queue = manager.Queue()
+task_queue = manager.TaskScheduler(LANE_WEIGHTS, TASK_LANES, DEFAULT_LANE, TASK_QUEUE_MAX_DEPTH)
 result_queue = manager.Queue()
-debug_print(f"Created manager queues: task_queue={type(task_queue)}, result_queue={type(result_queue)}")
+log.debug("Created manager queues: task_queue=%s, result_queue=%s", type(task_queue), type(result_queue))
+
+# The worker pool scales between MIN_WORKERS and MAX_WORKERS processes.
+# NUM_WORKERS, the old fixed pool size, is still honoured as the maximum.
+MAX_WORKERS = int(os.environ.get("MAX_WORKERS", os.environ.get("NUM_WORKERS", "20")))
+MIN_WORKERS = min(int(os.environ.get("MIN_WORKERS", "2")), MAX_WORKERS)
+# How often the pool checks queue depth and utilization
+SCALE_INTERVAL = float(os.environ.get("SCALE_INTERVAL", "1"))
+# Add workers when at least this many messages are waiting at a check
+SCALE_UP_QUEUE_DEPTH = int(os.environ.get("SCALE_UP_QUEUE_DEPTH", "1"))
+# Retire workers once utilization has stayed below this, with nothing
+# queued, for SCALE_DOWN_DELAY seconds
+SCALE_DOWN_UTILIZATION = float(os.environ.get("SCALE_DOWN_UTILIZATION", "0.25"))
+SCALE_DOWN_DELAY = float(os.environ.get("SCALE_DOWN_DELAY", "30"))
+# A worker that dies unexpectedly is restarted at once. If it dies again
+# within WORKER_RESTART_MAX_DELAY seconds of starting, the next restart
+# waits WORKER_RESTART_DELAY, doubling with each such death up to
+# WORKER_RESTART_MAX_DELAY, so one that can't start doesn't fork in a loop
+WORKER_RESTART_DELAY = float(os.environ.get("WORKER_RESTART_DELAY", "0.5"))
+WORKER_RESTART_MAX_DELAY = float(os.environ.get("WORKER_RESTART_MAX_DELAY", "30"))
+# Quick deaths in a row after which a worker's restarts are logged as errors
+WORKER_RESTART_ALERT_AFTER = 5
+
+# "locked" keeps one shared value behind a lock (strictly consistent);
+# "sharded" gives each worker its own slot and sums them on read
+COUNTER_BACKEND = os.environ.get("COUNTER_BACKEND", "locked")
+
+# Directory for the counter's write-ahead log and snapshots (see
+# counter_log.py). Empty keeps the counter in memory only, so it starts
+# from 0 on every restart.
+COUNTER_LOG_DIR = os.environ.get("COUNTER_LOG_DIR", "")
+# How long a worker waits for others to append before it fsyncs the log,
+# so one fsync covers them all. Even at 0, updates logged while an fsync
+# runs share the next one, so groups grow as the disk gets slower.
+COUNTER_LOG_GROUP_COMMIT_MS = float(os.environ.get("COUNTER_LOG_GROUP_COMMIT_MS", "0"))
+# How often a snapshot folds the log into snapshot.json, which bounds how
+# much a restart has to replay
+COUNTER_LOG_SNAPSHOT_INTERVAL = float(os.environ.get("COUNTER_LOG_SNAPSHOT_INTERVAL", "60"))
+
+# Replay the log before the counter exists, so it starts where it left off
+counter_log = None
+recovered = {"value": 0, "last_increment": None, "last_decrement": None}
+if COUNTER_LOG_DIR:
+    counter_log = CounterLog(COUNTER_LOG_DIR, COUNTER_LOG_GROUP_COMMIT_MS / 1000)
+    recovered = counter_log.state
+    log.info("Recovered counter %s from %s in %.3fs (%s log records replayed)",
+             recovered["value"], COUNTER_LOG_DIR, recovered["seconds"], recovered["records"])
 
-# Create a shared counter using multiprocessing.Value
-counter = multiprocessing.Value('i', 0)
-debug_print("Created shared counter with initial value 0")
+# Create the shared counter
+counter = make_counter(COUNTER_BACKEND, num_shards=MAX_WORKERS, initial=recovered["value"])
+log.info("Created %s shared counter with initial value %s", counter.name, recovered["value"])
+
+# Seconds of simulated work a decrement does before updating the counter
+DECREMENT_WORK_SECONDS = float(os.environ.get("DECREMENT_WORK_SECONDS", "3"))
 
 # Track processor information
 processor_info = manager.dict()
 processor_info['workers'] = manager.list()
+# Which processes last changed the counter are logged with it; the rest of
+# processor_info describes the running processes and starts afresh
+for key in ('last_increment', 'last_decrement'):
+    if recovered[key] is not None:
+        processor_info[key] = recovered[key]
+
+# How many recent task assignments /processor-info shows, and for how long
+TASK_HISTORY_SIZE = int(os.environ.get("TASK_HISTORY_SIZE", "1000"))
+TASK_HISTORY_TTL = float(os.environ.get("TASK_HISTORY_TTL", "600"))
+task_tracker = manager.TaskTracker(TASK_HISTORY_SIZE, TASK_HISTORY_TTL)
+
+# Results of tasks submitted with an idempotency key: how many keys to keep,
+# for how long, and how long after its deadline a task's claim lapses
+# (enough for a task picked up just in time to finish)
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", "10000"))
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", "600"))
+IDEMPOTENCY_CLAIM_GRACE = float(os.environ.get("IDEMPOTENCY_CLAIM_GRACE", str(DECREMENT_WORK_SECONDS + 2)))
+result_cache = manager.ResultCache(IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_TTL, IDEMPOTENCY_CLAIM_GRACE)
+
+# Per-API-process reply queues, keyed by the API server id sent with each task.
+# A value is either a manager queue or the name of a shared-memory reply ring.
+reply_queues = manager.dict()
+reply_queues_lock = threading.Lock()
+
+# "manager" passes tasks through the manager queue proxies. "shm" also serves
+# same-host clients from a shared-memory ring that workers read directly,
+# while remote clients keep using the manager queue (see shm_ring.py)
+TASK_TRANSPORT = os.environ.get("TASK_TRANSPORT", "manager")
+SHM_RING_PREFIX = os.environ.get("SHM_RING_PREFIX", "mpf_")
+SHM_RING_SLOTS = int(os.environ.get("SHM_RING_SLOTS", "1024"))
+SHM_RING_SLOT_SIZE = int(os.environ.get("SHM_RING_SLOT_SIZE", "4096"))
+# "compact" sends tasks and results over the rings, and results over the
+# reply queues, in the struct encoding of wire.py instead of as pickles
+WIRE_FORMAT = os.environ.get("WIRE_FORMAT", "pickle")
+wire_dumps = wire.ENCODERS[WIRE_FORMAT]
+# One ring per lane, created in the main block before the workers start
+# when TASK_TRANSPORT=shm
+task_rings = {}
+
+# Port of the manager's Prometheus /metrics endpoint; 0 turns it off
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9100"))
+# Per-worker task counts, busy time and latency histograms, written by the
+# workers without locking and summed when /metrics is scraped
+worker_stats = WorkerStats(MAX_WORKERS)
+
+# The first FAST_LANE_WORKERS worker ids serve only the fast lane, so there
+# is always a worker free for gets however many slow tasks are running
+FAST_LANE_WORKERS = min(int(os.environ.get("FAST_LANE_WORKERS", "1")), MAX_WORKERS - 1)
+
+# Put on the task queue (or ring) once per worker to tell it to exit
+STOP_WORKER = None
+# How long shutdown waits for workers to finish their current task
+WORKER_STOP_TIMEOUT = float(os.environ.get("WORKER_STOP_TIMEOUT", str(DECREMENT_WORK_SECONDS + 2)))
+# How long a drain (SIGTERM or Ctrl-C) lets the workers run the tasks
+# already queued before stopping them
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", "30"))
+# How long a drain lasts at the least, so API servers polling the load
+# report see it and send their tasks elsewhere before we go away
+DRAIN_NOTICE_SECONDS = float(os.environ.get("DRAIN_NOTICE_SECONDS", "2"))
+# How long a drain then waits for API servers to collect the results left
+# on their reply queues, which go away with the manager
+REPLY_FLUSH_TIMEOUT = 2
+# Set once a drain starts. The load report and /processor-info show it,
+# so API servers stop sending tasks here.
+draining = multiprocessing.Value('b', 0, lock=False)
 
 # Define functions to get the queues
 def get_task_queue():
     caller_id = f"{hostname}:{os.getpid()}"
-    debug_print(f"get_task_queue called by {caller_id}")
+    log.debug("get_task_queue called by %s", caller_id)
     return task_queue
 
 def get_result_queue():
     caller_id = f"{hostname}:{os.getpid()}"
-    debug_print(f"get_result_queue called by {caller_id}")
+    log.debug("get_result_queue called by %s", caller_id)
     return result_queue
 
+def get_reply_queue(reply_to):
+    caller_id = f"{hostname}:{os.getpid()}"
+    log.debug("get_reply_queue called by %s for %s", caller_id, reply_to)
+    # Each API process gets its own queue so results go straight to it
+    with reply_queues_lock:
+        if reply_to not in reply_queues:
+            reply_queues[reply_to] = manager.Queue()
+            log.debug("Created reply queue for %s", reply_to)
+        return reply_queues[reply_to]
+
+def register_reply_ring(reply_to, ring_name):
+    caller_id = f"{hostname}:{os.getpid()}"
+    log.debug("register_reply_ring called by %s: %s -> %s", caller_id, reply_to, ring_name)
+    # Workers attach to the ring by name the first time they reply to it
+    reply_queues[reply_to] = ring_name
+    return True
+
+def get_result_cache():
+    return result_cache
+
 def get_processor_info():
     caller_id = f"{hostname}:{os.getpid()}"
-    debug_print(f"get_processor_info called by {caller_id}")
+    log.debug("get_processor_info called by %s", caller_id)
     return processor_info
 
 def get_processor_info_dict():
     caller_id = f"{hostname}:{os.getpid()}"
-    debug_print(f"get_processor_info_dict called by {caller_id}")
+    log.debug("get_processor_info_dict called by %s", caller_id)
     # Convert the manager.dict to a regular dictionary
     result = {}
     for key in processor_info.keys():
@@ -62,238 +284,814 @@ def get_processor_info_dict():
             else:
                 result[key] = value
         except Exception as e:
-            debug_print(f"Error copying key {key}: {e}")
+            log.error("Error copying key %s: %s", key, e)
             result[key] = f"Error: {str(e)}"
     
     # Convert to string representation
     try:
         result_str = json.dumps(result)
-        debug_print(f"Converted processor info to JSON string: {len(result_str)} chars")
+        log.debug("Converted processor info to JSON string: %s chars", len(result_str))
         return result_str
     except Exception as e:
-        debug_print(f"Error converting to JSON: {e}")
+        log.error("Error converting to JSON: %s", e)
         return json.dumps({"error": "Failed to serialize processor info"})
 
 def update_processor_info(key, value):
     caller_id = f"{hostname}:{os.getpid()}"
-    debug_print(f"update_processor_info called by {caller_id}: {key}={value}")
+    log.debug("update_processor_info called by %s: %s=%s", caller_id, key, value)
     processor_info[key] = value
     return True
 
-def get_processor_info_as_string():
-    caller_id = f"{hostname}:{os.getpid()}"
-    debug_print(f"get_processor_info_as_string called by {caller_id}")
-    
+def build_processor_info_string():
     # Create a simple dictionary with basic information
     simple_info = {
         "server_hostname": hostname,
         "server_pid": process_id,
-        "counter_value": counter.value,
+        "counter_value": counter.get(),
+        "counter_backend": counter.name,
         "num_workers": len(list(processor_info.get('workers', []))),
         "worker_processes": [str(w) for w in list(processor_info.get('workers', []))],
         "last_increment": str(processor_info.get('last_increment', 'None')),
         "last_decrement": str(processor_info.get('last_decrement', 'None')),
-        "timestamp": time.strftime('%H:%M:%S')
+        "status": "draining" if draining.value else "serving",
+        "timestamp": time.strftime('%H:%M:%S'),
+        "generated_at": time.time()
     }
     
-    # Add task information
-    tasks = {}
-    for key in processor_info.keys():
-        if key.startswith('task_'):
-            tasks[key] = str(processor_info[key])
-    simple_info["tasks"] = tasks
-    
-    # Add API server information
-    api_servers = {}
-    for key in processor_info.keys():
-        if key.startswith('api_server_'):
-            api_servers[key] = str(processor_info[key])
-    simple_info["api_servers"] = api_servers
+    # Add recent task and API server information in one round trip
+    simple_info.update(task_tracker.snapshot())
     
     # Convert to JSON string - this should be safe since we're using only basic types
     try:
         json_str = json.dumps(simple_info)
-        debug_print(f"Created simple JSON string with {len(json_str)} chars")
+        log.debug("Created simple JSON string with %s chars", len(json_str))
         # Return the actual string value, not a proxy
         return json_str
     except Exception as e:
-        debug_print(f"Error creating JSON string: {e}")
-        debug_print(traceback.format_exc())
+        log.exception("Error creating JSON string: %s", e)
         # Return a hardcoded error string
         return '{"error": "Failed to create processor info string"}'
 
+class StatusBoard:
+    """Keeps the /processor-info document pre-serialized in the manager server.
+
+    A background thread rebuilds it every refresh_interval seconds, so
+    readers get the whole document in one call instead of one proxy round
+    trip per key. The thread starts on first use, inside the server process.
+    """
+
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self._json_str = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _ensure_refreshing(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._json_str = build_processor_info_string()
+            self._thread = threading.Thread(target=self._refresh_loop, name="status-board", daemon=True)
+            self._thread.start()
+            log.info("Status board refreshing every %ss", self.refresh_interval)
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self._json_str = build_processor_info_string()
+            except Exception as e:
+                log.error("Error refreshing status board: %s", e)
+
+    def snapshot(self):
+        """Return the latest processor info as a JSON string"""
+        if self._thread is None:
+            self._ensure_refreshing()
+        return self._json_str
+
+# How often the manager server rebuilds the processor info document
+STATUS_REFRESH_INTERVAL = float(os.environ.get("STATUS_REFRESH_INTERVAL", "1"))
+status_board = StatusBoard(STATUS_REFRESH_INTERVAL)
+
+def get_status_board():
+    caller_id = f"{hostname}:{os.getpid()}"
+    log.debug("get_status_board called by %s", caller_id)
+    return status_board
+
+def get_processor_info_as_string():
+    caller_id = f"{hostname}:{os.getpid()}"
+    log.debug("get_processor_info_as_string called by %s", caller_id)
+    return status_board.snapshot()
+
 class SharedDictManager:
     def __init__(self):
         self.process_id = os.getpid()
-        debug_print(f"SharedDictManager initialized in process {self.process_id}")
+        log.debug("SharedDictManager initialized in process %s", self.process_id)
         
     def get_counter(self):
         caller_id = f"{hostname}:{self.process_id}"
-        debug_print(f"get_counter called in process {caller_id}")
-        with counter.get_lock():
-            value = counter.value
-            debug_print(f"Current counter value: {value}")
-            return value, caller_id
+        log.debug("get_counter called in process %s", caller_id)
+        value = counter.get()
+        log.debug("Current counter value: %s", value)
+        return value, caller_id
         
-    def increment_counter(self):
+    def increment_counter(self, count=1):
         caller_id = f"{hostname}:{self.process_id}"
-        debug_print(f"increment_counter called in process {caller_id}")
-        with counter.get_lock():
-            counter.value += 1
-            debug_print(f"Incremented counter to {counter.value}")
-            processor_info['last_increment'] = caller_id
-            return counter.value, caller_id
+        log.debug("increment_counter called in process %s with count=%s", caller_id, count)
+        value = counter.increment(count)
+        log.debug("Incremented counter to %s", value)
+        if counter_log:
+            # Nobody hears about the increment until it is on disk
+            counter_log.record_increment(count)
+        processor_info['last_increment'] = caller_id
+        return value, caller_id
         
     def decrement_counter(self):
+        """Returns (value, caller_id, decremented); decremented is False if
+        the counter was already at 0"""
         caller_id = f"{hostname}:{self.process_id}"
-        debug_print(f"decrement_counter called in process {caller_id}")
-        with counter.get_lock():
-            debug_print(f"Sleeping for 3 seconds in process {caller_id}")
-            time.sleep(3)
+        log.debug("decrement_counter called in process %s", caller_id)
+        # Do the slow work before touching the counter so other workers can
+        # keep reading and incrementing it meanwhile
+        log.debug("Working for %s seconds in process %s", DECREMENT_WORK_SECONDS, caller_id)
+        time.sleep(DECREMENT_WORK_SECONDS)
+        
+        decremented, value = counter.decrement()
+        if decremented:
+            log.debug("Decremented counter to %s", value)
+            if counter_log:
+                counter_log.record_decrement()
+        else:
+            log.debug("Counter already at 0, not decrementing")
             
-            if counter.value > 0:
-                counter.value -= 1
-                debug_print(f"Decremented counter to {counter.value}")
+        processor_info['last_decrement'] = caller_id
+        return value, caller_id, decremented
+
+def parse_task(task):
+    """Split a task message into (task_id, task_type, reply_to, enqueued_at, deadline)
+
+    deadline is a time.time() after which nobody is waiting for the result.
+    """
+    if len(task) == 5:
+        return task
+    if len(task) >= 3:
+        return (*task, *(None,) * (5 - len(task)))
+    task_id, task_type = task
+    return task_id, task_type, None, None, None
+
+def drop_expired(worker_name, tasks):
+    """Split off the tasks whose deadline has passed, returning (live, expired)"""
+    now = time.time()
+    live = []
+    expired = []
+    for task in tasks:
+        deadline = parse_task(task)[4]
+        if deadline is not None and now > deadline:
+            expired.append(task)
+        else:
+            live.append(task)
+    if expired:
+        log.debug("Worker %s dropping %s expired task(s)", worker_name, len(expired))
+    return live, expired
+
+def drop_cancelled(worker_name, message, tasks):
+    """Drop the tasks their API server has cancelled since they were queued"""
+    if not tasks or lane_for(message, TASK_LANES, DEFAULT_LANE) not in CANCEL_CHECK_LANES:
+        return tasks
+    cancelled = set(task_queue.take_cancelled([task[0] for task in tasks]))
+    if not cancelled:
+        return tasks
+    log.debug("Worker %s dropping %s cancelled task(s)", worker_name, len(cancelled))
+    return [task for task in tasks if task[0] not in cancelled]
+
+def run_tasks(shared_dict_manager, worker_name, tasks, picked_up_at):
+    """Run a batch of tasks, returning [(reply_to, (task_id, result, processor, trace))].
+
+    Tasks run in batch order. A run of consecutive increments is applied
+    as a single counter update; each one still gets the value it would
+    have seen on its own. trace holds the worker's monotonic timestamps
+    for the task (see app.py), and "noop": True for a decrement that found
+    the counter at 0, so an API server with other shards can send it on to
+    one that has a count.
+    """
+    parsed = [parse_task(task) for task in tasks]
+    task_tracker.record_many([(task_id, worker_name, reply_to) for task_id, _, reply_to, _, _ in parsed])
+    
+    outcomes = [None] * len(parsed)
+    # (seconds waited for the counter lock, monotonic time the task finished)
+    timings = [None] * len(parsed)
+    noops = set()
+    # Runs of consecutive tasks of one type; a get between two increments
+    # splits them, so it sees the first and not the second
+    for task_type, run in itertools.groupby(range(len(parsed)), key=lambda i: parsed[i][1]):
+        run = list(run)
+        if task_type == "increment":
+            lock_wait = counter.lock_wait
+            value, processor = shared_dict_manager.increment_counter(len(run))
+            timing = (counter.lock_wait - lock_wait, time.monotonic())
+            first_value = value - len(run) + 1
+            for n, i in enumerate(run):
+                outcomes[i] = (first_value + n, processor)
+                timings[i] = timing
+            continue
+        for i in run:
+            lock_wait = counter.lock_wait
+            if task_type == "decrement":
+                value, processor, decremented = shared_dict_manager.decrement_counter()
+                outcomes[i] = (value, processor)
+                if not decremented:
+                    noops.add(i)
+            elif task_type == "get":
+                outcomes[i] = shared_dict_manager.get_counter()
             else:
-                debug_print(f"Counter already at 0, not decrementing")
-                
-            processor_info['last_decrement'] = caller_id
-            return counter.value, caller_id
+                log.warning("Worker %s received unknown task type: %s", worker_name, task_type)
+                outcomes[i] = (None, worker_name)
+            timings[i] = (counter.lock_wait - lock_wait, time.monotonic())
+    
+    replies = [
+        (reply_to, (task_id, result, processor,
+                    {"picked_up": picked_up_at, "lock_wait": lock_wait, "completed": completed_at}))
+        for (task_id, _, reply_to, _, _), (result, processor), (lock_wait, completed_at) in zip(parsed, outcomes, timings)
+    ]
+    for i in noops:
+        # The compact wire format doesn't carry this, so these go pickled
+        replies[i][1][3]["noop"] = True
+    return replies
+
+def send_replies(worker_name, replies, worker_reply_queues):
+    """Put results on their API process's reply queue, one message per queue"""
+    by_reply_to = {}
+    for reply_to, result_data in replies:
+        by_reply_to.setdefault(reply_to, []).append(result_data)
+    
+    for reply_to, results in by_reply_to.items():
+        # Send the result to the API process that submitted the task,
+        # falling back to the shared result queue for old clients
+        target_queue = result_queue
+        if reply_to is not None:
+            if reply_to not in worker_reply_queues:
+                try:
+                    target = reply_queues[reply_to]
+                    if isinstance(target, str):
+                        target = ShmRing.attach(target, dumps=wire_dumps)
+                    worker_reply_queues[reply_to] = target
+                except (KeyError, FileNotFoundError):
+                    log.warning("Worker %s has no reply queue for %s, using result queue", worker_name, reply_to)
+            target_queue = worker_reply_queues.get(reply_to, result_queue)
+        
+        log.debug("Worker %s putting %s result(s) in queue for reply_to=%s", worker_name, len(results), reply_to)
+        # Old clients on the shared result queue only understand single
+        # (task_id, result, processor) results
+        if target_queue is result_queue:
+            messages = [result_data[:3] for result_data in results]
+        elif len(results) == 1:
+            messages = results
+        else:
+            messages = [results]
+        for message in messages:
+            if isinstance(target_queue, ShmRing):
+                try:
+                    # Don't wait forever on a ring whose reader has gone away
+                    target_queue.put(message, timeout=1)
+                except queue.Full:
+                    log.warning("Worker %s dropped result for %s: reply ring is full", worker_name, reply_to)
+            elif target_queue is not result_queue and WIRE_FORMAT == "compact":
+                # The proxy then only has to pickle a bytes object
+                target_queue.put(wire.dumps(message))
+            else:
+                target_queue.put(message)
+
+def worker_lanes(worker_id):
+    if worker_id < FAST_LANE_WORKERS:
+        return ("fast",)
+    return tuple(LANE_WEIGHTS)
+
+def ring_for(message):
+    lane = lane_for(message, TASK_LANES, DEFAULT_LANE)
+    return task_rings[lane or CONTROL_LANE]
+
+def forward_remote_tasks():
+    """Move tasks that remote clients put on the manager queue onto the rings"""
+    while True:
+        try:
+            message = task_queue.get()
+        except Exception as e:
+            if draining.value:
+                # The manager server is shutting down after a drain
+                return
+            log.error("Error forwarding remote tasks: %s", e)
+            time.sleep(1)
+            continue
+        ring = ring_for(message)
+        try:
+            ring.put(message)
+        except ValueError:
+            # A batch too big for one slot goes over task by task
+            for task in message:
+                ring.put(task)
+
+def worker_label(pid, worker_id):
+    return f"{hostname}:{pid} (Worker {worker_id})"
 
 def worker_process(worker_id):
     """Worker process function that processes tasks from the queue"""
     process_id = os.getpid()
-    worker_name = f"{hostname}:{process_id} (Worker {worker_id})"
-    debug_print(f"Worker process {worker_name} started")
+    worker_name = worker_label(process_id, worker_id)
+    log.info("Worker process %s started", worker_name)
+    
+    # The main process tells workers to stop with STOP_WORKER
+    ignore_stop_signals()
+    exit_with_parent()
+    
+    # Claim this worker's slot in the counter (used by the sharded backend)
+    counter.bind_worker(worker_id)
     
-    # Add this worker to the processor info
-    processor_info['workers'].append(worker_name)
+    # Block until a task arrives in one of this worker's lanes
+    lanes = worker_lanes(worker_id)
+    if task_rings:
+        next_task = RingLaneReader(task_rings, lanes, LANE_WEIGHTS).get
+    else:
+        next_task = lambda: task_queue.get(lanes=lanes)
+    log.debug("Worker %s serves lanes %s", worker_name, lanes)
     
     shared_dict_manager = SharedDictManager()
-    debug_print(f"Worker process {worker_name} created SharedDictManager")
+    log.debug("Worker process %s created SharedDictManager", worker_name)
+    
+    # Cache reply queue proxies so we only look each one up once
+    worker_reply_queues = {}
     
     # Check if queues are empty at start
     try:
-        debug_print(f"Worker {worker_name} task queue size at start: {task_queue.qsize()}")
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Worker %s task queue size at start: %s", worker_name, task_queue.qsize())
     except Exception as e:
-        debug_print(f"Worker {worker_name} can't get task queue size: {e}")
+        log.warning("Worker %s can't get task queue size: %s", worker_name, e)
     
     while True:
         try:
-            debug_print(f"Worker {worker_name} waiting for task...")
-            # Get a task from the queue with a timeout to allow for debugging
+            # Sleep until a task arrives instead of polling
             try:
-                debug_print(f"Worker {worker_name} about to call task_queue.get(block=True, timeout=1)")
-                task = task_queue.get(block=True, timeout=1)
-                debug_print(f"Worker {worker_name} got task: {task}")
-            except queue.Empty:
-                # This is expected when the queue is empty
-                debug_print(f"Worker {worker_name} task queue is empty, continuing...")
-                continue
+                task = next_task()
+                log.debug("Worker %s got task: %s", worker_name, task)
+            except (EOFError, ConnectionError) as e:
+                # The manager holding the queue is gone; nothing more will arrive
+                log.warning("Worker %s lost the task queue (%s), exiting", worker_name, e)
+                return
             except Exception as e:
-                debug_print(f"Worker {worker_name} error in task_queue.get(): {e}")
-                debug_print(traceback.format_exc())
+                log.exception("Worker %s error in task_queue.get(): %s", worker_name, e)
                 time.sleep(1)  # Wait a bit before retrying
                 continue
             
+            if task is STOP_WORKER:
+                log.info("Worker %s received stop signal, exiting", worker_name)
+                return
+            
+            picked_up_at = time.monotonic()
             try:
-                task_id, task_type = task
-                debug_print(f"Worker {worker_name} processing task_id={task_id}, type={task_type}")
-                processor_info[f'task_{task_id}'] = worker_name
-                
-                if task_type == "increment":
-                    result, processor = shared_dict_manager.increment_counter()
-                elif task_type == "decrement":
-                    result, processor = shared_dict_manager.decrement_counter()
-                elif task_type == "get":
-                    result, processor = shared_dict_manager.get_counter()
-                else:
-                    debug_print(f"Worker {worker_name} received unknown task type: {task_type}")
-                    result = None
-                    processor = worker_name
-                    
-                # Put the result back in the result queue with the task ID
-                debug_print(f"Worker {worker_name} putting result in queue: task_id={task_id}, result={result}")
-                result_queue.put((task_id, result, processor))
-                debug_print(f"Worker {worker_name} finished processing task {task_id}")
-                
-                # Check result queue size after putting result
-                try:
-                    debug_print(f"Worker {worker_name} result queue size after put: {result_queue.qsize()}")
-                except Exception as e:
-                    debug_print(f"Worker {worker_name} can't get result queue size: {e}")
+                # A message is either one task or a batch of them
+                tasks = task if isinstance(task, list) else [task]
+                # Whoever sent an expired task has already given up on it
+                tasks, expired = drop_expired(worker_name, tasks)
+                if expired:
+                    worker_stats.record_expired(worker_id, len(expired))
+                    # A retry of any of them can run now instead of waiting
+                    # for the claim to lapse
+                    result_cache.release([t[0] for t in expired])
+                live = drop_cancelled(worker_name, task, tasks)
+                if len(live) < len(tasks):
+                    worker_stats.record_cancelled(worker_id, len(tasks) - len(live))
+                tasks = live
+                if not tasks:
+                    continue
+                log.debug("Worker %s processing %s task(s)", worker_name, len(tasks))
+                replies = run_tasks(shared_dict_manager, worker_name, tasks, picked_up_at)
+                send_replies(worker_name, replies, worker_reply_queues)
+                log.debug("Worker %s finished processing %s task(s)", worker_name, len(tasks))
                 
+                replied_at = time.monotonic()
+                enqueued = [t[3] for t in map(parse_task, tasks) if t[3] is not None]
+                worker_stats.record(
+                    worker_id, len(tasks), replied_at - picked_up_at,
+                    [picked_up_at - e for e in enqueued], [replied_at - e for e in enqueued])
             except Exception as e:
-                debug_print(f"Worker {worker_name} error processing task: {e}")
-                debug_print(traceback.format_exc())
+                log.exception("Worker %s error processing task: %s", worker_name, e)
         except Exception as e:
-            debug_print(f"Error in worker process {worker_name} main loop: {e}")
-            debug_print(traceback.format_exc())
+            log.exception("Error in worker process %s main loop: %s", worker_name, e)
             time.sleep(1)  # Wait a bit before continuing
 
+def queue_depths():
+    depths = {(f"task_queue_{lane}",): size for lane, size in task_queue.lane_sizes().items()}
+    depths[("result_queue",)] = result_queue.qsize()
+    for lane, ring in task_rings.items():
+        depths[(f"task_ring_{lane}",)] = ring.qsize()
+    return depths
+
+# Everything the manager's /metrics reports; gauges are read at scrape time
+metrics = Registry()
+metrics.gauge("mpf_queue_depth", "Messages waiting in each task and result queue", queue_depths, ("queue",))
+metrics.gauge("mpf_reply_queues", "API processes with a registered reply queue or ring", lambda: len(reply_queues))
+metrics.gauge("mpf_counter_value", "Current value of the shared counter", counter.get)
+metrics.gauge("mpf_draining", "1 while the manager server is draining before it exits", lambda: draining.value)
+metrics.gauge("mpf_idempotency_cache_entries", "Idempotency keys with a running or completed task", result_cache.size)
+metrics.gauge("mpf_worker_tasks_total", "Tasks run by each worker", worker_stats.task_counts, ("worker",), type="counter")
+metrics.gauge("mpf_worker_expired_tasks_total", "Tasks each worker dropped because their deadline had passed", worker_stats.expired_counts, ("worker",), type="counter")
+metrics.gauge("mpf_worker_cancelled_tasks_total", "Tasks each worker dropped because their API server cancelled them", worker_stats.cancelled_counts, ("worker",), type="counter")
+metrics.gauge("mpf_worker_busy_seconds_total", "Seconds each worker spent running tasks", worker_stats.busy_seconds, ("worker",), type="counter")
+if counter_log:
+    metrics.gauge("mpf_counter_log_appends_total", "Counter updates written to the write-ahead log",
+                  counter_log.appends, type="counter")
+    metrics.gauge("mpf_counter_log_fsyncs_total", "fsyncs of the write-ahead log; each covers every update written before it",
+                  counter_log.fsyncs, type="counter")
+    metrics.gauge("mpf_counter_log_snapshots_total", "Snapshots the write-ahead log was folded into",
+                  lambda: counter_log.snapshots, type="counter")
+    metrics.gauge("mpf_counter_log_bytes", "Bytes logged since the last snapshot", counter_log.log_bytes)
+metrics.register(WorkerHistogram(
+    "mpf_task_pickup_seconds", "Time from an API process enqueuing a task to a worker picking it up",
+    worker_stats, "pickup"))
+metrics.register(WorkerHistogram(
+    "mpf_task_complete_seconds", "Time from an API process enqueuing a task to a worker sending its result",
+    worker_stats, "complete"))
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("metrics: " + format, *args)
+
+def serve_metrics(port):
+    server = http.server.ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    log.info("Serving metrics on port %s", port)
+
+def lane_depths():
+    depths = task_queue.lane_sizes()
+    for lane, ring in task_rings.items():
+        depths[lane] += ring.qsize()
+    return depths
+
+class LoadReport:
+    """What API servers need to decide whether to admit a task.
+
+    Shared with them through a proxy like the status board; snapshot()
+    returns plain values in one round trip.
+    """
+
+    def snapshot(self):
+        return {
+            "queued": lane_depths(),
+            # Workers that can serve each lane once the pool has scaled up;
+            # the pool adds workers within SCALE_INTERVAL of tasks queueing
+            "capacity": {lane: MAX_WORKERS - (0 if lane == "fast" else FAST_LANE_WORKERS) for lane in LANE_WEIGHTS},
+            "lanes": {"types": TASK_LANES, "default": DEFAULT_LANE},
+            "draining": bool(draining.value),
+            # Changes when the manager server restarts
+            "server": f"{hostname}:{process_id}",
+        }
+
+load_report = LoadReport()
+
+def get_load_report():
+    return load_report
+
+class CounterReader:
+    """Reads the counter for API servers without going through a worker.
+
+    The manager server process maps the counter's shared memory like the
+    workers do, so a read is one round trip and never waits in a lane.
+    """
+
+    def read(self):
+        return counter.get(), f"{hostname}:{os.getpid()} (manager)"
+
+counter_reader = CounterReader()
+
+def get_counter_reader():
+    return counter_reader
+
+def get_server_threads():
+    # Runs inside the manager server process, which serves each client
+    # connection on its own thread
+    return threading.active_count()
+
+def snapshot_counter_log():
+    """Fold the counter log into a snapshot every COUNTER_LOG_SNAPSHOT_INTERVAL seconds"""
+    while True:
+        time.sleep(COUNTER_LOG_SNAPSHOT_INTERVAL)
+        try:
+            if counter_log.snapshot():
+                log.debug("Snapshotted counter log")
+        except Exception as e:
+            log.exception("Can't snapshot the counter log: %s", e)
+
+def flush_replies(timeout):
+    """Wait up to timeout seconds for API servers to collect the results on
+    their reply queues. Reply rings belong to the API servers, so they keep
+    their results when the manager exits."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        waiting = result_queue.qsize() + sum(
+            target.qsize() for target in reply_queues.values() if not isinstance(target, str))
+        if not waiting:
+            return 0
+        time.sleep(0.05)
+    return waiting
+
+def put_stop(lane=None):
+    """Ask whichever worker serving lane is free next to exit, or whichever
+    worker at all with no lane"""
+    if task_rings:
+        task_rings[lane or CONTROL_LANE].put(STOP_WORKER)
+    elif lane is not None:
+        task_queue.put_stop(STOP_WORKER, lane)
+    else:
+        task_queue.put(STOP_WORKER)
+
+class WorkerPool:
+    """Supervises the worker processes from the main process.
+
+    Keeps between min_workers and max_workers running. Workers are added
+    when tasks are waiting, since an idle worker would have taken them
+    already, and retired one at a time after utilization has stayed low
+    for scale_down_delay seconds; the fast-lane-only workers are never
+    retired. A worker that dies without being asked to is replaced, after
+    a delay that grows while it keeps dying soon after starting. Each
+    worker gets a free id below max_workers, which is its slot in the
+    sharded counter and in worker_stats.
+    """
+
+    def __init__(self, min_workers, max_workers, interval, scale_down_delay):
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.interval = interval
+        self.scale_down_delay = scale_down_delay
+        # worker_id -> Process
+        self.workers = {}
+        # Stop messages sent that no worker has acted on yet
+        self.retiring = 0
+        self.restarts = 0
+        # worker_id -> when it started, deaths soon after starting in a row,
+        # and when a worker that died is due to be restarted
+        self._started = {}
+        self._failures = {}
+        self._restart_at = {}
+        self._quiet_since = None
+        self._last_check = None
+        self._last_busy = 0.0
+
+    @property
+    def active(self):
+        """Workers that are running and haven't been asked to stop"""
+        return len(self.workers) - self.retiring
+
+    @property
+    def restarting(self):
+        """Workers that died and are waiting to be restarted"""
+        return len(self._restart_at)
+
+    def start_worker(self, worker_id=None):
+        if worker_id is None:
+            worker_id = min(set(range(self.max_workers)) - set(self.workers) - set(self._restart_at))
+        p = multiprocessing.Process(target=worker_process, args=(worker_id,))
+        p.daemon = True  # Set as daemon so they exit when the main process exits
+        p.start()
+        self.workers[worker_id] = p
+        self._started[worker_id] = time.monotonic()
+        processor_info['workers'].append(worker_label(p.pid, worker_id))
+        log.debug("Started worker process %s with PID %s", worker_id, p.pid)
+
+    def start(self):
+        log.info("Starting %s worker processes (scaling between %s and %s)",
+                 self.min_workers, self.min_workers, self.max_workers)
+        for _ in range(self.min_workers):
+            self.start_worker()
+        self._last_check = time.monotonic()
+        self._last_busy = sum(worker_stats.busy_seconds().values())
+
+    def _reap(self):
+        for worker_id, p in list(self.workers.items()):
+            if p.is_alive():
+                continue
+            p.join()
+            del self.workers[worker_id]
+            try:
+                processor_info['workers'].remove(worker_label(p.pid, worker_id))
+            except ValueError:
+                pass
+            # Only workers serving RETIRE_LANE take retire stops
+            lived = time.monotonic() - self._started.pop(worker_id)
+            if p.exitcode == 0 and self.retiring and worker_id >= FAST_LANE_WORKERS:
+                self.retiring -= 1
+                self._failures.pop(worker_id, None)
+                log.info("Worker %s (PID %s) retired", worker_id, p.pid)
+                continue
+            failures = self._failures.get(worker_id, 0) + 1 if lived < WORKER_RESTART_MAX_DELAY else 1
+            self._failures[worker_id] = failures
+            delay = 0 if failures == 1 else min(WORKER_RESTART_DELAY * 2 ** (failures - 2), WORKER_RESTART_MAX_DELAY)
+            self._restart_at[worker_id] = time.monotonic() + delay
+            self.restarts += 1
+            if failures >= WORKER_RESTART_ALERT_AFTER:
+                log.error("Worker %s (PID %s) died with exit code %s, %s times in a row soon after starting; restarting it in %.1fs",
+                          worker_id, p.pid, p.exitcode, failures, delay)
+            else:
+                log.warning("Worker %s (PID %s) died with exit code %s, restarting it in %.1fs",
+                            worker_id, p.pid, p.exitcode, delay)
+        now = time.monotonic()
+        for worker_id, due in list(self._restart_at.items()):
+            if due <= now:
+                del self._restart_at[worker_id]
+                self.start_worker(worker_id)
+
+    def _wake_at(self):
+        """When the supervisor next has something to do if no worker exits"""
+        return min([self._last_check + self.interval, *self._restart_at.values()])
+
+    def retirable(self):
+        """Workers a retire stop can reach that haven't been sent one"""
+        return sum(1 for worker_id in self.workers if worker_id >= FAST_LANE_WORKERS) - self.retiring
+
+    def queued(self):
+        return sum(lane_depths().values())
+
+    def _scale(self):
+        now = time.monotonic()
+        busy = sum(worker_stats.busy_seconds().values())
+        utilization = (busy - self._last_busy) / (max(self.active, 1) * (now - self._last_check))
+        self._last_check, self._last_busy = now, busy
+        depth = self.queued()
+        log.debug("Worker pool: %s active, %s retiring, %s queued, utilization %.2f",
+                  self.active, self.retiring, depth, utilization)
+        
+        if depth >= SCALE_UP_QUEUE_DEPTH and self.active < self.max_workers:
+            self._quiet_since = None
+            added = min(depth, self.max_workers - len(self.workers) - len(self._restart_at))
+            for _ in range(added):
+                self.start_worker()
+            if added:
+                log.info("Scaled up by %s to %s workers (%s tasks queued)", added, self.active, depth)
+            return
+        
+        if depth == 0 and utilization < SCALE_DOWN_UTILIZATION:
+            if self._quiet_since is None:
+                self._quiet_since = now
+            if (now - self._quiet_since >= self.scale_down_delay and self.active > self.min_workers
+                    and self.retirable() > 0):
+                self.retiring += 1
+                put_stop(RETIRE_LANE)
+                log.info("Scaling down to %s workers (utilization %.2f)", self.active, utilization)
+        else:
+            self._quiet_since = None
+
+    def run(self):
+        """Supervise until interrupted, waking as soon as any worker exits"""
+        while True:
+            sentinels = [p.sentinel for p in self.workers.values()]
+            multiprocessing.connection.wait(sentinels, max(0, self._wake_at() - time.monotonic()))
+            self._reap()
+            if time.monotonic() - self._last_check >= self.interval:
+                try:
+                    self._scale()
+                except Exception as e:
+                    log.warning("Worker pool can't check the task queue: %s", e)
+
+    def stop(self):
+        """Send every worker STOP_WORKER and wait for them to exit"""
+        for _ in range(self.active):
+            put_stop()
+        
+        deadline = time.monotonic() + WORKER_STOP_TIMEOUT
+        for p in self.workers.values():
+            p.join(max(0, deadline - time.monotonic()))
+            if p.is_alive():
+                log.warning("Worker process %s didn't stop in time, killing it", p.pid)
+                # Workers ignore SIGTERM
+                p.kill()
+                p.join()
+        log.info("All worker processes stopped")
+
+    def drain(self, timeout, notice):
+        """Stop once the queued tasks have been picked up and notice seconds
+        have passed, or after timeout seconds, still scaling up to get
+        through the tasks meanwhile.
+
+        Returns how many tasks were left queued.
+        """
+        started = time.monotonic()
+        deadline = started + max(timeout, notice)
+        while (self.queued() or time.monotonic() - started < notice) and time.monotonic() < deadline:
+            sentinels = [p.sentinel for p in self.workers.values()]
+            multiprocessing.connection.wait(sentinels, max(0, min(self._wake_at(), deadline) - time.monotonic()))
+            self._reap()
+            if time.monotonic() - self._last_check >= self.interval:
+                try:
+                    self._scale()
+                except Exception as e:
+                    log.warning("Worker pool can't check the task queue: %s", e)
+        left = self.queued()
+        # Workers finish the task they are running before they see the stop
+        self.stop()
+        return left
+
+worker_pool = WorkerPool(MIN_WORKERS, MAX_WORKERS, SCALE_INTERVAL, SCALE_DOWN_DELAY)
+metrics.gauge("mpf_workers", "Worker processes running", lambda: len(worker_pool.workers))
+metrics.gauge("mpf_workers_retiring", "Workers asked to stop that haven't exited yet", lambda: worker_pool.retiring)
+metrics.gauge("mpf_workers_restarting", "Workers that died waiting out their restart delay",
+              lambda: worker_pool.restarting)
+metrics.gauge("mpf_worker_restarts_total", "Workers replaced after dying unexpectedly",
+              lambda: worker_pool.restarts, type="counter")
+
 class MyManager(SyncManager):
     pass
 
 if __name__ == "__main__":
-    debug_print("Entering main block")
+    log.debug("Entering main block")
     
     # Register the queues and processor info with the manager
-    debug_print("Registering queues with manager")
+    log.debug("Registering queues with manager")
     MyManager.register('get_task_queue', callable=get_task_queue)
     MyManager.register('get_result_queue', callable=get_result_queue)
+    MyManager.register('get_reply_queue', callable=get_reply_queue)
+    MyManager.register('register_reply_ring', callable=register_reply_ring)
     MyManager.register('get_processor_info', callable=get_processor_info)
     MyManager.register('get_processor_info_dict', callable=get_processor_info_dict)
     MyManager.register('get_processor_info_as_string', callable=get_processor_info_as_string)
+    MyManager.register('get_status_board', callable=get_status_board)
     MyManager.register('update_processor_info', callable=update_processor_info)
+    MyManager.register('get_server_threads', callable=get_server_threads)
+    MyManager.register('get_load_report', callable=get_load_report)
+    MyManager.register('get_counter_reader', callable=get_counter_reader)
+    MyManager.register('get_result_cache', callable=get_result_cache)
+    
+    # Before the manager server forks, so its load report can see the rings
+    if TASK_TRANSPORT == "shm":
+        for lane in LANE_WEIGHTS:
+            task_rings[lane] = ShmRing(f"{SHM_RING_PREFIX}tasks_{lane}", SHM_RING_SLOTS, SHM_RING_SLOT_SIZE, create=True, dumps=wire_dumps)
+            log.info("Created shared-memory task ring %s", task_rings[lane].name)
+        # Same-host clients look the rings up here and attach to them by name
+        processor_info['task_rings'] = {lane: ring.name for lane, ring in task_rings.items()}
+        processor_info['task_lanes'] = {"types": TASK_LANES, "default": DEFAULT_LANE}
     
     # Create the manager server
-    debug_print("Creating manager server on port 50000")
-    server_manager = MyManager(address=('127.0.0.1', 50000), authkey=b'secret')
+    log.debug("Creating manager server on %s:%s", MANAGER_HOST, MANAGER_PORT)
+    server_manager = MyManager(address=(MANAGER_HOST, MANAGER_PORT), authkey=MANAGER_AUTHKEY)
     
     try:
-        debug_print("Starting manager server")
-        server_manager.start()
-        debug_print("Manager server started successfully")
+        log.debug("Starting manager server")
+        server_manager.start(init_child_process)
+        log.info("Manager server started successfully")
     except Exception as e:
-        debug_print(f"Error starting manager: {e}")
-        debug_print(traceback.format_exc())
+        log.exception("Error starting manager: %s", e)
         sys.exit(1)
     
-    # Number of worker processes
-    num_workers = 20
-    debug_print(f"Creating {num_workers} worker processes")
+    worker_pool.start()
+    log.info("All worker processes started")
     
-    # Create and start worker processes
-    processes = []
-    for i in range(num_workers):
-        try:
-            debug_print(f"Creating worker process {i}")
-            p = multiprocessing.Process(target=worker_process, args=(i,))
-            p.daemon = True  # Set as daemon so they exit when the main process exits
-            debug_print(f"Starting worker process {i}")
-            p.start()
-            processes.append(p)
-            debug_print(f"Started worker process {i} with PID {p.pid}")
-        except Exception as e:
-            debug_print(f"Error creating worker process {i}: {e}")
-            debug_print(traceback.format_exc())
+    if task_rings:
+        threading.Thread(target=forward_remote_tasks, name="remote-task-forwarder", daemon=True).start()
+    
+    if counter_log:
+        threading.Thread(target=snapshot_counter_log, name="counter-log-snapshots", daemon=True).start()
+    
+    if METRICS_PORT:
+        metrics.gauge(
+            "mpf_manager_server_threads", "Threads in the manager server process, one per client connection plus a few",
+            lambda: server_manager.get_server_threads()._getvalue())
+        serve_metrics(METRICS_PORT)
+    log.info("Manager server running on %s:%s...", MANAGER_HOST, MANAGER_PORT)
     
-    debug_print("All worker processes started")
-    debug_print("Manager server running on port 50000...")
+    # SIGTERM drains like Ctrl-C, so a supervisor can restart us cleanly
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
     
-    # Keep the main process running
+    # The main process supervises and scales the workers from here on
     try:
-        debug_print("Entering main loop")
-        while True:
-            # Periodically check queue sizes
-            try:
-                debug_print(f"Main process task queue size: {task_queue.qsize()}")
-                debug_print(f"Main process result queue size: {result_queue.qsize()}")
-            except Exception as e:
-                debug_print(f"Main process can't get queue sizes: {e}")
-            
-            time.sleep(5)  # Check every 5 seconds
+        log.debug("Entering main loop")
+        worker_pool.run()
     except KeyboardInterrupt:
-        debug_print("Received KeyboardInterrupt, shutting down...")
+        log.info("Draining: taking no new tasks, running the %s queued for up to %ss",
+                 worker_pool.queued(), DRAIN_TIMEOUT)
+        # Ignore a second signal rather than cut the drain short
+        ignore_stop_signals()
+        draining.value = 1
+        task_queue.close()
+        left = worker_pool.drain(DRAIN_TIMEOUT, DRAIN_NOTICE_SECONDS)
+        if left:
+            log.warning("Drain timed out with %s task(s) still queued; they will not run", left)
+        unclaimed = flush_replies(REPLY_FLUSH_TIMEOUT)
+        if unclaimed:
+            log.warning("%s result(s) were never collected from their reply queues", unclaimed)
+        if counter_log:
+            # The workers are gone, so this covers every update and the next
+            # start has nothing to replay
+            counter_log.snapshot()
+        for ring in task_rings.values():
+            ring.unlink()
         server_manager.shutdown()
-        debug_print("Manager shutdown complete")
\ No newline at end of file
+        log.info("Manager shutdown complete")
@@ -0,0 +1,222 @@
+import bisect
+import multiprocessing
+import threading
+
+# Upper bounds in seconds, from sub-millisecond queue hops to the slow decrement
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _format_value(value):
+    # Shared-memory counts are doubles; print whole numbers without ".0"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+def _format_histogram(name, labelnames, labels, buckets, counts, total):
+    """Exposition lines of one histogram series; counts are per bucket, not cumulative"""
+    lines = []
+    cumulative = 0
+    for bound, count in zip(buckets + (float("inf"),), counts):
+        cumulative += count
+        le = "+Inf" if bound == float("inf") else repr(bound)
+        lines.append(f"{name}_bucket{_format_labels(labelnames + ('le',), labels + (le,))} {_format_value(cumulative)}")
+    lines.append(f"{name}_sum{_format_labels(labelnames, labels)} {_format_value(total)}")
+    lines.append(f"{name}_count{_format_labels(labelnames, labels)} {_format_value(cumulative)}")
+    return lines
+
+class Counter:
+    """A monotonically increasing value per label combination"""
+
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        if not values and not self.labelnames:
+            values = {(): 0}
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}" for labels, value in sorted(values.items())]
+
+class Gauge:
+    """A value read at scrape time from fn.
+
+    fn returns a number, or a dict of {label values tuple: number} when the
+    gauge has labels. Nothing is stored, so there's no cost between scrapes.
+    Pass type="counter" for a total that another process keeps.
+    """
+
+    def __init__(self, name, help, fn, labelnames=(), type="gauge"):
+        self.type = type
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+
+    def samples(self):
+        value = self.fn()
+        values = value if isinstance(value, dict) else {(): value}
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(v)}" for labels, v in sorted(values.items())]
+
+class Histogram:
+    """Bucketed observations per label combination"""
+
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def samples(self):
+        with self._lock:
+            series = {labels: (list(counts), total) for labels, (counts, total) in self._series.items()}
+        lines = []
+        for labels, (counts, total) in sorted(series.items()):
+            lines.extend(_format_histogram(self.name, self.labelnames, labels, self.buckets, counts, total))
+        return lines
+
+class Registry:
+    """The metrics of one process, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, fn, labelnames=(), type="gauge"):
+        return self.register(Gauge(name, help, fn, labelnames, type))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            try:
+                samples = metric.samples()
+            except Exception:
+                # A gauge whose source is unreachable is left out of this scrape
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+class WorkerStats:
+    """Per-worker task counts, busy time, dropped tasks and latency histograms
+    in shared memory.
+
+    Each worker writes only its own row, so recording takes no lock and no
+    message to another process; a scrape sums the rows. Like the sharded
+    counter, rows are padded to whole cache lines.
+    """
+
+    # tasks, busy seconds, expired and cancelled tasks, then count-per-bucket
+    # and sum for each histogram
+    HISTOGRAMS = ("pickup", "complete")
+    COLUMNS = 4
+
+    def __init__(self, num_workers, buckets=LATENCY_BUCKETS):
+        self.num_workers = num_workers
+        self.buckets = tuple(buckets)
+        self._histogram_width = len(self.buckets) + 2
+        width = self.COLUMNS + len(self.HISTOGRAMS) * self._histogram_width
+        # Round up to a multiple of 8 doubles (64 bytes)
+        self._stride = -(-width // 8) * 8
+        self._rows = multiprocessing.Array('d', num_workers * self._stride, lock=False)
+
+    def _histogram_offset(self, worker_id, histogram):
+        return worker_id * self._stride + self.COLUMNS + self.HISTOGRAMS.index(histogram) * self._histogram_width
+
+    def _observe(self, worker_id, histogram, value):
+        offset = self._histogram_offset(worker_id, histogram)
+        self._rows[offset + bisect.bisect_left(self.buckets, value)] += 1
+        self._rows[offset + len(self.buckets) + 1] += value
+
+    def record(self, worker_id, tasks, busy_seconds, pickup_latencies=(), complete_latencies=()):
+        """Record a message of `tasks` tasks that kept the worker busy for
+        busy_seconds, with each task's enqueue->pickup and enqueue->complete
+        latency where the task carried its enqueue time"""
+        row = worker_id * self._stride
+        self._rows[row] += tasks
+        self._rows[row + 1] += busy_seconds
+        for value in pickup_latencies:
+            self._observe(worker_id, "pickup", value)
+        for value in complete_latencies:
+            self._observe(worker_id, "complete", value)
+
+    def record_expired(self, worker_id, tasks):
+        """Record tasks the worker dropped because their deadline had passed"""
+        self._rows[worker_id * self._stride + 2] += tasks
+
+    def record_cancelled(self, worker_id, tasks):
+        """Record tasks the worker dropped because their API server cancelled them"""
+        self._rows[worker_id * self._stride + 3] += tasks
+
+    def task_counts(self):
+        return {(str(w),): self._rows[w * self._stride] for w in range(self.num_workers)}
+
+    def busy_seconds(self):
+        return {(str(w),): self._rows[w * self._stride + 1] for w in range(self.num_workers)}
+
+    def expired_counts(self):
+        return {(str(w),): self._rows[w * self._stride + 2] for w in range(self.num_workers)}
+
+    def cancelled_counts(self):
+        return {(str(w),): self._rows[w * self._stride + 3] for w in range(self.num_workers)}
+
+class WorkerHistogram:
+    """One WorkerStats histogram summed over all workers, for a Registry"""
+
+    type = "histogram"
+
+    def __init__(self, name, help, stats, histogram):
+        self.name = name
+        self.help = help
+        self.stats = stats
+        self.histogram = histogram
+
+    def samples(self):
+        stats = self.stats
+        width = len(stats.buckets) + 1
+        counts = [0.0] * width
+        total = 0.0
+        for w in range(stats.num_workers):
+            offset = stats._histogram_offset(w, self.histogram)
+            for i in range(width):
+                counts[i] += stats._rows[offset + i]
+            total += stats._rows[offset + width]
+        return _format_histogram(self.name, (), (), stats.buckets, counts, total)
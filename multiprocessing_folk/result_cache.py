@@ -0,0 +1,79 @@
+import collections
+import threading
+import time
+
+class ResultCache:
+    """Results of tasks submitted with an idempotency key, for their retries.
+
+    Lives in the manager process and is shared through a proxy. The first
+    request for a key claims it with its task id; later requests with the
+    same key get ("running", task_id) until that task completes, then its
+    result. Completed results are kept for ttl seconds, and at most
+    max_entries keys are kept in all, oldest dropped first.
+
+    A claim lapses claim_grace seconds after its task's deadline: a worker
+    drops a task whose deadline has passed without running it, and one
+    that picked the task up in time is done by then. Workers release the
+    claims of tasks they drop, so a retry can run at once.
+    """
+
+    def __init__(self, max_entries=10000, ttl=600, claim_grace=5):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.claim_grace = claim_grace
+        # key -> [task_id, result_data (None while running), expires_at]
+        self._entries = collections.OrderedDict()
+        # task_id -> key of every claim still running
+        self._claims = {}
+        # The manager serves each client connection in its own thread
+        self._lock = threading.Lock()
+
+    def _drop(self, key):
+        task_id, _, _ = self._entries.pop(key)
+        self._claims.pop(task_id, None)
+
+    def claim(self, key, task_id, deadline):
+        """Claim key for task_id, which must finish by deadline (a time.time()).
+
+        Returns ("claimed", task_id), ("running", owner_task_id) or
+        ("done", result_data).
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] < now:
+                self._drop(key)
+                entry = None
+            if entry is not None:
+                owner, result_data, _ = entry
+                if result_data is None:
+                    return "running", owner
+                return "done", result_data
+            self._entries[key] = [task_id, None, deadline + self.claim_grace]
+            self._claims[task_id] = key
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+            return "claimed", task_id
+
+    def complete(self, results):
+        """Record [(task_id, result_data)] for the tasks that hold claims"""
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            for task_id, result_data in results:
+                key = self._claims.pop(task_id, None)
+                if key is None:
+                    continue
+                self._entries[key] = [task_id, result_data, expires_at]
+                self._entries.move_to_end(key)
+
+    def release(self, task_ids):
+        """Give up the claims of tasks that will never run"""
+        with self._lock:
+            for task_id in task_ids:
+                key = self._claims.pop(task_id, None)
+                if key is not None:
+                    del self._entries[key]
+
+    def size(self):
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,249 @@
+import fcntl
+import os
+import queue
+import select
+import struct
+import threading
+import time
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import wire
+
+# Where the notification FIFO and lock file of each ring live
+SHM_RING_DIR = os.environ.get("SHM_RING_DIR", "/tmp")
+
+# head (next slot to read) and tail (next slot to write), both ever-increasing
+COUNTERS = struct.Struct("QQ")
+# Slot count and size, so processes that attach by name know the layout
+LAYOUT = struct.Struct("II")
+HEADER_SIZE = COUNTERS.size + LAYOUT.size
+LENGTH = struct.Struct("I")
+# Where SharedMemory blocks show up as files, on Linux
+SHM_DIR = "/dev/shm"
+
+def _running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def remove_stale_rings(prefix):
+    """Remove the rings named prefix + "<pid>_..." whose creator has exited.
+
+    A creator that is killed never calls unlink(), so its FIFO and lock
+    file stay behind, and its shared memory too if the resource tracker
+    went with it. Returns the names of the rings removed.
+    """
+    names = set()
+    for directory in (SHM_RING_DIR, SHM_DIR):
+        try:
+            entries = os.listdir(directory)
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.startswith(prefix):
+                names.add(entry.removesuffix(".fifo").removesuffix(".lock"))
+    removed = []
+    for name in sorted(names):
+        pid = name[len(prefix):].split("_", 1)[0]
+        if not pid.isdigit() or _running(int(pid)):
+            continue
+        for path in (os.path.join(SHM_RING_DIR, f"{name}.fifo"), os.path.join(SHM_RING_DIR, f"{name}.lock")):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        try:
+            stale = SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            # Or another process swept it first
+            pass
+        removed.append(name)
+    return removed
+
+class ShmRing:
+    """A multi-producer, multi-consumer queue on a shared-memory ring buffer.
+
+    Messages are encoded into fixed-size slots of a SharedMemory block, so a
+    put or get never goes through another process. They are pickled, or
+    encoded with the given dumps (such as wire.dumps); get decodes either. Any process on the host
+    can open the ring by name. Slot access is serialized with flock on a
+    lock file. Consumers sleep on a FIFO that gets one byte per message
+    (a semaphore that unrelated processes can share), so each message wakes
+    one consumer and idle consumers use no CPU. A token only says a
+    message may be waiting: consumers take the message under the lock,
+    then a token, and a token left over wakes a consumer that finds
+    nothing and takes it.
+    """
+
+    def __init__(self, name, slots=1024, slot_size=4096, create=False, dumps=wire.pickle_dumps):
+        if create and slots > 65536:
+            # One wake-up byte per message has to fit in the pipe buffer
+            raise ValueError("ShmRing supports at most 65536 slots")
+        self.name = name
+        self._dumps = dumps
+        self._fifo_path = os.path.join(SHM_RING_DIR, f"{name}.fifo")
+        self._lock_path = os.path.join(SHM_RING_DIR, f"{name}.lock")
+        self._owner = create
+        if create:
+            size = HEADER_SIZE + slots * slot_size
+            try:
+                self._shm = SharedMemory(name=name, create=True, size=size)
+            except FileExistsError:
+                # Left behind by a process that didn't shut down cleanly
+                stale = SharedMemory(name=name)
+                stale.close()
+                stale.unlink()
+                self._shm = SharedMemory(name=name, create=True, size=size)
+            COUNTERS.pack_into(self._shm.buf, 0, 0, 0)
+            LAYOUT.pack_into(self._shm.buf, COUNTERS.size, slots, slot_size)
+            if not os.path.exists(self._fifo_path):
+                os.mkfifo(self._fifo_path)
+            open(self._lock_path, "a").close()
+        else:
+            self._shm = SharedMemory(name=name)
+            # The creator owns the block; don't let our resource tracker
+            # unlink it when this process exits
+            resource_tracker.unregister(self._shm._name, "shared_memory")
+        self.slots, self.slot_size = LAYOUT.unpack_from(self._shm.buf, COUNTERS.size)
+        self._pid = None
+        self._open_fds()
+
+    @classmethod
+    def attach(cls, name, dumps=wire.pickle_dumps):
+        """Open a ring that another process created"""
+        return cls(name, dumps=dumps)
+
+    def _open_fds(self):
+        # flock and the FIFO need descriptors of our own: ones inherited
+        # through fork share a lock with the parent and would not exclude it
+        self._pid = os.getpid()
+        self._thread_lock = threading.Lock()
+        self._lock_fd = os.open(self._lock_path, os.O_RDWR)
+        # O_RDWR keeps the FIFO open without a peer and never reads EOF
+        self._fifo_fd = os.open(self._fifo_path, os.O_RDWR | os.O_NONBLOCK)
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._open_fds()
+
+    def _lock(self):
+        self._thread_lock.acquire()
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+
+    def _unlock(self):
+        fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+    def put(self, obj, block=True, timeout=None):
+        """Put obj on the ring. Raises ValueError if it doesn't fit in a slot."""
+        self._check_pid()
+        data = self._dumps(obj)
+        if len(data) > self.slot_size - LENGTH.size:
+            raise ValueError(f"Message of {len(data)} bytes doesn't fit in a {self.slot_size}-byte slot")
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.0001
+        while True:
+            self._lock()
+            try:
+                buf = self._shm.buf
+                head, tail = COUNTERS.unpack_from(buf, 0)
+                if tail - head < self.slots:
+                    offset = HEADER_SIZE + (tail % self.slots) * self.slot_size
+                    LENGTH.pack_into(buf, offset, len(data))
+                    start = offset + LENGTH.size
+                    buf[start:start + len(data)] = data
+                    COUNTERS.pack_into(buf, 0, head, tail + 1)
+                    break
+            finally:
+                self._unlock()
+            # Full: consumers are behind, back off until a slot frees up
+            if not block or (deadline is not None and time.monotonic() >= deadline):
+                raise queue.Full
+            time.sleep(delay)
+            delay = min(delay * 2, 0.01)
+
+        os.write(self._fifo_fd, b"\0")
+
+    def _pop(self):
+        """The oldest message's bytes, or None if the ring is empty"""
+        self._lock()
+        try:
+            buf = self._shm.buf
+            head, tail = COUNTERS.unpack_from(buf, 0)
+            if head == tail:
+                return None
+            offset = HEADER_SIZE + (head % self.slots) * self.slot_size
+            (length,) = LENGTH.unpack_from(buf, offset)
+            start = offset + LENGTH.size
+            data = bytes(buf[start:start + length])
+            COUNTERS.pack_into(buf, 0, head + 1, tail)
+            return data
+        finally:
+            self._unlock()
+
+    def _take_token(self):
+        try:
+            os.read(self._fifo_fd, 1)
+            return True
+        except BlockingIOError:
+            return False
+
+    def get(self, block=True, timeout=None):
+        self._check_pid()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            # Take the message first and its wake-up token after, so a
+            # consumer killed in between leaves a token over rather than a
+            # message no token will ever wake anyone for
+            data = self._pop()
+            if data is not None:
+                # The token may not be written yet, leaving one over later
+                self._take_token()
+                return wire.loads(data)
+            if self._take_token():
+                # A token whose message someone else took; a message may
+                # have come with it, so look again
+                continue
+            if not block:
+                raise queue.Empty
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise queue.Empty
+            select.select([self._fifo_fd], [], [], remaining)
+
+    def fileno(self):
+        """The FIFO a consumer can select() on; readable while messages may wait"""
+        self._check_pid()
+        return self._fifo_fd
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        head, tail = COUNTERS.unpack_from(self._shm.buf, 0)
+        return tail - head
+
+    def close(self):
+        if self._pid == os.getpid():
+            os.close(self._lock_fd)
+            os.close(self._fifo_fd)
+        self._shm.close()
+
+    def unlink(self):
+        """Remove the ring from the system. Only the creator should call this."""
+        self.close()
+        if self._owner:
+            self._shm.unlink()
+            for path in (self._fifo_path, self._lock_path):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,218 @@
+import collections
+import queue
+import select
+import threading
+import time
+
+def lane_for(message, lane_of_type, default_lane):
+    """The lane a task message belongs to; a batch goes by its first task.
+
+    Returns None for anything that isn't a task, such as a stop message.
+    """
+    if not message:
+        return None
+    task = message[0] if isinstance(message, list) else message
+    return lane_of_type.get(task[1], default_lane)
+
+class Draining(Exception):
+    """Raised by TaskScheduler.put once the manager server is draining"""
+
+class LanePicker:
+    """Smooth weighted round-robin over lanes.
+
+    Each pick goes to the ready lane furthest behind its share, so with
+    weights fast=4, slow=1 and both lanes busy, the picks run
+    fast, fast, slow, fast, fast: never more than one slow task in a row.
+    """
+
+    def __init__(self, weights):
+        self.weights = dict(weights)
+        self._current = {lane: 0 for lane in self.weights}
+
+    def pick(self, ready):
+        total = 0
+        best = None
+        for lane in ready:
+            weight = self.weights[lane]
+            self._current[lane] += weight
+            total += weight
+            if best is None or self._current[lane] > self._current[best]:
+                best = lane
+        self._current[best] -= total
+        return best
+
+class TaskScheduler:
+    """Per-lane task queues with weighted fair dequeue.
+
+    Lives in the manager process and is shared through a proxy in place of
+    the single task queue: put, get and qsize behave like queue.Queue, and
+    get additionally takes the lanes the calling worker serves. Messages
+    that aren't tasks (stop messages) skip the lanes and go to the next
+    worker that asks, whichever lanes it serves, or with put_stop() to the
+    next worker that serves a given lane. Each lane holds at most
+    maxsize messages (0 for no limit); stop messages are never refused.
+    Once close() is called, put refuses new tasks with Draining, while
+    workers go on taking the ones already queued.
+
+    cancel() takes tasks back out of the lanes. Cancelled tasks that have
+    already left (a worker has them, or they went over a ring instead) are
+    remembered, up to max_cancelled of them, for workers to look up with
+    take_cancelled() before running them.
+    """
+
+    def __init__(self, weights, lane_of_type, default_lane, maxsize=0, max_cancelled=10000):
+        self.lane_of_type = dict(lane_of_type)
+        self.default_lane = default_lane
+        self.maxsize = maxsize
+        self._lanes = {lane: collections.deque() for lane in weights}
+        self._control = collections.deque()
+        # Stop messages for the next worker serving each lane
+        self._stops = {lane: collections.deque() for lane in weights}
+        self._picker = LanePicker(weights)
+        # The manager serves each client connection in its own thread.
+        # Waiters are grouped by the lanes they serve so a put only wakes
+        # a worker that can take it.
+        self._lock = threading.Lock()
+        self._waiters = {}
+        self._not_full = {lane: threading.Condition(self._lock) for lane in weights}
+        self.max_cancelled = max_cancelled
+        self._cancelled = collections.OrderedDict()
+        self._closed = False
+
+    def _condition(self, lanes):
+        condition = self._waiters.get(lanes)
+        if condition is None:
+            condition = self._waiters[lanes] = threading.Condition(self._lock)
+        return condition
+
+    def put(self, message, block=True, timeout=None):
+        lane = lane_for(message, self.lane_of_type, self.default_lane)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            if lane is None:
+                self._control.append(message)
+            else:
+                if self._closed:
+                    raise Draining("The manager server is draining and takes no new tasks")
+                tasks = self._lanes[lane]
+                while self.maxsize and len(tasks) >= self.maxsize:
+                    if not block:
+                        raise queue.Full
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise queue.Full
+                    self._not_full[lane].wait(remaining)
+                tasks.append(message)
+            for lanes, condition in self._waiters.items():
+                if lane is None or lane in lanes:
+                    condition.notify()
+
+    def get(self, block=True, timeout=None, lanes=None):
+        lanes = tuple(lanes) if lanes is not None else tuple(self._lanes)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            condition = self._condition(lanes)
+            while True:
+                if self._control:
+                    return self._control.popleft()
+                for lane in lanes:
+                    if self._stops[lane]:
+                        return self._stops[lane].popleft()
+                ready = [lane for lane in lanes if self._lanes[lane]]
+                if ready:
+                    lane = self._picker.pick(ready)
+                    self._not_full[lane].notify()
+                    return self._lanes[lane].popleft()
+                if not block:
+                    raise queue.Empty
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                condition.wait(remaining)
+
+    def put_stop(self, message, lane):
+        """Put a stop message for the next worker that serves lane"""
+        with self._lock:
+            self._stops[lane].append(message)
+            for lanes, condition in self._waiters.items():
+                if lane in lanes:
+                    condition.notify()
+
+    def close(self):
+        """Refuse new tasks from now on"""
+        with self._lock:
+            self._closed = True
+
+    def cancel(self, task_ids):
+        """Cancel tasks by id, returning how many were still queued"""
+        task_ids = set(task_ids)
+        removed = set()
+        with self._lock:
+            for lane, tasks in self._lanes.items():
+                kept = collections.deque()
+                changed = False
+                for message in tasks:
+                    batch = message if isinstance(message, list) else [message]
+                    remaining = [task for task in batch if task[0] not in task_ids]
+                    if len(remaining) == len(batch):
+                        kept.append(message)
+                        continue
+                    changed = True
+                    removed.update(task[0] for task in batch if task[0] in task_ids)
+                    if remaining:
+                        kept.append(remaining)
+                if changed:
+                    self._lanes[lane] = kept
+                    self._not_full[lane].notify(len(tasks) - len(kept))
+            for task_id in task_ids - removed:
+                self._cancelled[task_id] = True
+            while len(self._cancelled) > self.max_cancelled:
+                self._cancelled.popitem(last=False)
+        return len(removed)
+
+    def take_cancelled(self, task_ids):
+        """Which of task_ids have been cancelled; each is reported once"""
+        with self._lock:
+            return [task_id for task_id in task_ids if self._cancelled.pop(task_id, None)]
+
+    def qsize(self):
+        with self._lock:
+            return (len(self._control) + sum(len(stops) for stops in self._stops.values())
+                    + sum(len(tasks) for tasks in self._lanes.values()))
+
+    def lane_sizes(self):
+        with self._lock:
+            return {lane: len(tasks) for lane, tasks in self._lanes.items()}
+
+class RingLaneReader:
+    """Takes tasks from per-lane shared-memory rings, picking between lanes
+    with the same weighted round-robin as TaskScheduler.
+
+    Each worker has its own reader for the lanes it serves, and sleeps on
+    all of their rings at once until one has a message.
+    """
+
+    def __init__(self, rings, lanes, weights):
+        self.rings = [rings[lane] for lane in lanes]
+        self._by_lane = dict(zip(lanes, self.rings))
+        self._picker = LanePicker({lane: weights[lane] for lane in lanes})
+
+    def get(self):
+        while True:
+            ready = [lane for lane, ring in self._by_lane.items() if ring.qsize()]
+            while ready:
+                lane = self._picker.pick(ready)
+                try:
+                    return self._by_lane[lane].get_nowait()
+                except queue.Empty:
+                    # Another worker got there first
+                    ready.remove(lane)
+            readable, _, _ = select.select(self.rings, [], [])
+            for ring in readable:
+                if not ring.qsize():
+                    # A wake-up whose message another worker took; taking
+                    # the token keeps select from returning at once again
+                    try:
+                        return ring.get_nowait()
+                    except queue.Empty:
+                        pass
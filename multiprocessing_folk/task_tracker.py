@@ -0,0 +1,90 @@
+import collections
+import threading
+import time
+
+class TaskTracker:
+    """Bounded record of recent task assignments plus per-worker totals.
+
+    Lives in the manager process and is shared through a proxy. Only the
+    last max_tasks assignments (and none older than ttl seconds) are kept,
+    so memory and snapshot cost stay flat however long the server runs.
+    The per-worker and per-API-server task counts go by the same limits:
+    a worker or API server process not seen for ttl seconds is dropped,
+    and at most max_tasks of each are kept, least recently seen dropped
+    first. Workers come and go with the pool, and each process is a new
+    label, so keeping them all would grow without end. total_tasks
+    counts every task.
+    """
+
+    def __init__(self, max_tasks=1000, ttl=None):
+        self.max_tasks = max_tasks
+        self.ttl = ttl
+        # task_id -> (worker_name, api_server, recorded_at), oldest first
+        self._recent = collections.OrderedDict()
+        # label -> [task count, last seen], least recently seen first
+        self._worker_counts = collections.OrderedDict()
+        self._api_server_counts = collections.OrderedDict()
+        self._total = 0
+        # The manager serves each client connection in its own thread
+        self._lock = threading.Lock()
+
+    def record(self, task_id, worker_name, api_server=None):
+        self.record_many([(task_id, worker_name, api_server)])
+
+    def record_many(self, records):
+        """Record a batch of (task_id, worker_name, api_server) in one call"""
+        now = time.time()
+        with self._lock:
+            for task_id, worker_name, api_server in records:
+                self._recent[task_id] = (worker_name, api_server, now)
+                self._recent.move_to_end(task_id)
+                self._count(self._worker_counts, worker_name, now)
+                if api_server is not None:
+                    self._count(self._api_server_counts, api_server, now)
+                self._total += 1
+            for entries in (self._recent, self._worker_counts, self._api_server_counts):
+                while len(entries) > self.max_tasks:
+                    entries.popitem(last=False)
+
+    @staticmethod
+    def _count(counts, label, now):
+        entry = counts.get(label)
+        if entry is None:
+            counts[label] = [1, now]
+        else:
+            entry[0] += 1
+            entry[1] = now
+            counts.move_to_end(label)
+
+    def _expire(self, now):
+        if not self.ttl:
+            return
+        while self._recent:
+            task_id, (_, _, recorded_at) = next(iter(self._recent.items()))
+            if now - recorded_at <= self.ttl:
+                break
+            self._recent.popitem(last=False)
+        for counts in (self._worker_counts, self._api_server_counts):
+            while counts:
+                _, last_seen = next(iter(counts.values()))
+                if now - last_seen <= self.ttl:
+                    break
+                counts.popitem(last=False)
+
+    def snapshot(self):
+        """Return everything as plain data in a single call"""
+        with self._lock:
+            self._expire(time.time())
+            tasks = {}
+            api_servers = {}
+            for task_id, (worker_name, api_server, _) in self._recent.items():
+                tasks[f"task_{task_id}"] = worker_name
+                if api_server is not None:
+                    api_servers[f"api_server_{task_id}"] = api_server
+            return {
+                "tasks": tasks,
+                "api_servers": api_servers,
+                "worker_task_counts": {label: count for label, (count, _) in self._worker_counts.items()},
+                "api_server_task_counts": {label: count for label, (count, _) in self._api_server_counts.items()},
+                "total_tasks": self._total,
+            }
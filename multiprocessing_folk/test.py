@@ -1,8 +1,11 @@
 import requests
 import time
 import json
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
-BASE_URL = 'http://localhost:8000'
+BASE_URL = os.environ.get('API_URL', 'http://localhost:8000')
 
 def print_separator(title):
     """Print a separator with a title for better test output readability"""
@@ -120,6 +123,62 @@ def test_counter_sequence():
     
     print("\nCounter sequence test passed!")
 
+def test_idempotency():
+    """Test that a repeated Idempotency-Key replays the first result"""
+    print_separator("IDEMPOTENCY TEST")
+    
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+    initial = test_counter_value()
+    
+    first = requests.get(f"{BASE_URL}/increment", headers=headers)
+    assert first.status_code == 200, f"Expected status code 200, got {first.status_code}"
+    print(f"First request: {first.json()}")
+    
+    retry = requests.get(f"{BASE_URL}/increment", headers=headers)
+    assert retry.status_code == 200, f"Expected status code 200, got {retry.status_code}"
+    print(f"Retry: {retry.json()}, Idempotent-Replayed: {retry.headers.get('Idempotent-Replayed')}")
+    assert retry.headers.get("Idempotent-Replayed") == "true", "Expected the retry to be replayed"
+    assert retry.json()["task_id"] == first.json()["task_id"], "Expected the retry to return the first task's result"
+    
+    # The counter went up once for the two requests
+    val = test_counter_value()
+    assert val == initial + 1, f"Expected {initial + 1}, got {val}"
+    
+    print("\nIdempotency test passed!")
+
+def test_concurrent_idempotency():
+    """Test that a duplicate sent while the first request runs gets its result"""
+    print_separator("CONCURRENT IDEMPOTENCY TEST")
+    
+    key = str(uuid.uuid4())
+    # The decrement must have something to take away, or it is a no-op
+    requests.get(f"{BASE_URL}/increment")
+    initial = test_counter_value()
+    
+    # Decrement runs for seconds, so the duplicate arrives while it does
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first = executor.submit(requests.get, f"{BASE_URL}/decrement", headers={"Idempotency-Key": key})
+        time.sleep(0.5)
+        duplicate = executor.submit(requests.get, f"{BASE_URL}/decrement",
+                                    headers={"Idempotency-Key": key, "X-Debug-Timing": "1"})
+        first, duplicate = first.result(), duplicate.result()
+    
+    assert first.status_code == 200, f"Expected status code 200, got {first.status_code}"
+    assert duplicate.status_code == 200, f"Expected status code 200, got {duplicate.status_code}"
+    print(f"First request: {first.json()}")
+    print(f"Duplicate: {duplicate.json()}, Idempotent-Replayed: {duplicate.headers.get('Idempotent-Replayed')}")
+    assert duplicate.headers.get("Idempotent-Replayed") == "true", "Expected the duplicate to be replayed"
+    assert duplicate.json()["task_id"] == first.json()["task_id"], "Expected the duplicate to return the first task's result"
+    # The duplicate asked for timing and the first request didn't
+    assert "Server-Timing" in duplicate.headers, "Expected the duplicate to get its timing"
+    assert "Server-Timing" not in first.headers, "Expected no timing for the first request"
+    
+    # The counter went down once for the two requests
+    val = test_counter_value()
+    assert val == initial - 1, f"Expected {initial - 1}, got {val}"
+    
+    print("\nConcurrent idempotency test passed!")
+
 def test_response_times():
     """Test response times for different endpoints"""
     print_separator("RESPONSE TIME TEST")
@@ -185,6 +244,8 @@ if __name__ == "__main__":
         
         # More complex tests
         test_counter_sequence()
+        test_idempotency()
+        test_concurrent_idempotency()
         test_response_times()
         test_error_handling()
         
@@ -0,0 +1,191 @@
+import math
+import pickle
+import struct
+
+# Task types sent as a one-byte code. A message with any other type is
+# pickled instead.
+TASK_TYPES = ("increment", "decrement", "get")
+TASK_TYPE_CODES = {task_type: code for code, task_type in enumerate(TASK_TYPES)}
+
+# The first byte says what a compact message holds. Pickles start with
+# 0x80 (the PROTO opcode), so loads() can tell the two formats apart.
+TASK, TASK_BATCH, RESULT, RESULT_BATCH = 1, 2, 3, 4
+BATCH = struct.Struct("<BH")
+# kind, task_id, task type code, enqueued_at, deadline; then reply_to
+TASK_MESSAGE = struct.Struct("<BQBdd")
+# kind, task_id, has result, result, picked_up, lock_wait, completed; then processor
+RESULT_MESSAGE = struct.Struct("<BQ?qddd")
+# A batch is its kind, count and the string its messages share, then
+# records that leave out the kind byte and the string
+TASK_RECORD = struct.Struct("<QBdd")
+RESULT_RECORD = struct.Struct("<Q?qddd")
+TRACE_FIELDS = 3
+
+# Strings go as a length byte and UTF-8; this length stands for None
+NONE_STRING = 0xFF
+# The same few reply_to and processor names appear in every message, so
+# each process keeps them encoded (and decoded) once
+MAX_INTERNED = 4096
+_encoded = {None: bytes([NONE_STRING])}
+_decoded = {bytes([NONE_STRING]): None}
+
+# Stands in for an absent timestamp or trace
+NAN = math.nan
+NO_TRACE = (NAN, NAN, NAN)
+
+def _intern(s):
+    raw = _encoded.get(s)
+    if raw is None:
+        data = s.encode()
+        if len(data) >= NONE_STRING:
+            raise ValueError("String too long for the compact format")
+        raw = bytes([len(data)]) + data
+        if len(_encoded) < MAX_INTERNED:
+            _encoded[s] = raw
+            _decoded[raw] = s
+    return raw
+
+def _string(raw):
+    s = _decoded.get(raw, NAN)
+    if s is NAN:
+        s = raw[1:].decode()
+        if len(_decoded) < MAX_INTERNED:
+            _decoded[raw] = s
+            _encoded[s] = raw
+    return s
+
+def _float(value):
+    return NAN if value is None else value
+
+def _optional(value):
+    return None if value != value else value
+
+def _task_fields(task):
+    task_id, task_type, reply_to, enqueued, deadline = task
+    return (task_id, TASK_TYPE_CODES[task_type], _float(enqueued), _float(deadline)), _intern(reply_to)
+
+def _result_fields(result_data):
+    task_id, result, processor, trace = result_data
+    if trace is None:
+        times = NO_TRACE
+    elif len(trace) == TRACE_FIELDS:
+        times = (trace["picked_up"], trace["lock_wait"], trace["completed"])
+    else:
+        raise ValueError("Trace has fields the compact format doesn't carry")
+    return (task_id, result is not None, result or 0, *times), _intern(processor)
+
+def _task(fields, reply_to):
+    task_id, code, enqueued, deadline = fields
+    return (task_id, TASK_TYPES[code], _string(reply_to), _optional(enqueued), _optional(deadline))
+
+def _result(fields, processor):
+    task_id, has_result, result, picked_up, lock_wait, completed = fields
+    trace = None if picked_up != picked_up else {"picked_up": picked_up, "lock_wait": lock_wait, "completed": completed}
+    return (task_id, result if has_result else None, _string(processor), trace)
+
+def _compact(message):
+    if type(message) is tuple:
+        if len(message) == 5:
+            fields, reply_to = _task_fields(message)
+            return TASK_MESSAGE.pack(TASK, *fields) + reply_to
+        if len(message) == 4:
+            fields, processor = _result_fields(message)
+            return RESULT_MESSAGE.pack(RESULT, *fields) + processor
+    elif type(message) is list and message and all(type(m) is tuple for m in message):
+        # A batch goes to one API process, or comes back from one worker,
+        # so its messages share their reply_to or processor
+        string = message[0][2]
+        if any(m[2] != string for m in message):
+            return None
+        if all(len(m) == 5 for m in message):
+            codes = TASK_TYPE_CODES
+            records = [
+                TASK_RECORD.pack(task_id, codes[task_type],
+                                 NAN if enqueued is None else enqueued, NAN if deadline is None else deadline)
+                for task_id, task_type, _, enqueued, deadline in message
+            ]
+            kind = TASK_BATCH
+        elif all(len(m) == 4 and (m[3] is None or len(m[3]) == TRACE_FIELDS) for m in message):
+            records = [
+                RESULT_RECORD.pack(task_id, result is not None, result or 0,
+                                   *(NO_TRACE if trace is None else (trace["picked_up"], trace["lock_wait"], trace["completed"])))
+                for task_id, result, _, trace in message
+            ]
+            kind = RESULT_BATCH
+        else:
+            return None
+        return BATCH.pack(kind, len(message)) + _intern(string) + b"".join(records)
+    return None
+
+def dumps(message):
+    """Encode a task or result message, or a batch of either, as compact bytes.
+
+    Tasks are (task_id, task_type, reply_to, enqueued_at, deadline) and
+    results (task_id, result, processor, trace), with integer task ids and
+    results. Anything else (stop messages, legacy shapes, string task ids,
+    unknown task types) is pickled, so every message can be sent this way.
+    """
+    # The common cases in one struct call, once their string is interned
+    if type(message) is tuple and len(message) == 5:
+        task_id, task_type, reply_to, enqueued, deadline = message
+        code = TASK_TYPE_CODES.get(task_type)
+        tail = _encoded.get(reply_to)
+        if (code is not None and tail is not None and type(task_id) is int
+                and type(enqueued) is float and type(deadline) is float):
+            try:
+                return TASK_MESSAGE.pack(TASK, task_id, code, enqueued, deadline) + tail
+            except struct.error:
+                pass
+    elif type(message) is tuple and len(message) == 4:
+        task_id, result, processor, trace = message
+        tail = _encoded.get(processor)
+        if tail is not None and type(task_id) is int and type(result) is int and type(trace) is dict and len(trace) == TRACE_FIELDS:
+            try:
+                return RESULT_MESSAGE.pack(RESULT, task_id, True, result, trace["picked_up"], trace["lock_wait"], trace["completed"]) + tail
+            except (struct.error, KeyError):
+                pass
+    try:
+        data = _compact(message)
+    except (struct.error, KeyError, TypeError, ValueError, AttributeError):
+        data = None
+    if data is None:
+        return pickle_dumps(message)
+    return data
+
+def pickle_dumps(message):
+    return pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+
+def loads(data):
+    """Decode a message from dumps() or pickle_dumps()"""
+    kind = data[0]
+    if kind == TASK:
+        _, task_id, code, enqueued, deadline = fields = TASK_MESSAGE.unpack_from(data)
+        reply_to = _decoded.get(data[TASK_MESSAGE.size:], NAN)
+        if reply_to is not NAN and enqueued == enqueued and deadline == deadline:
+            return (task_id, TASK_TYPES[code], reply_to, enqueued, deadline)
+        return _task(fields[1:], data[TASK_MESSAGE.size:])
+    if kind == RESULT:
+        _, task_id, has_result, result, picked_up, lock_wait, completed = fields = RESULT_MESSAGE.unpack_from(data)
+        processor = _decoded.get(data[RESULT_MESSAGE.size:], NAN)
+        if processor is not NAN and has_result and picked_up == picked_up:
+            return (task_id, result, processor, {"picked_up": picked_up, "lock_wait": lock_wait, "completed": completed})
+        return _result(fields[1:], data[RESULT_MESSAGE.size:])
+    if kind == TASK_BATCH or kind == RESULT_BATCH:
+        length = data[BATCH.size]
+        records = BATCH.size + 1 + (length if length != NONE_STRING else 0)
+        string = _string(data[BATCH.size:records])
+        if kind == TASK_BATCH:
+            return [
+                (task_id, TASK_TYPES[code], string,
+                 enqueued if enqueued == enqueued else None, deadline if deadline == deadline else None)
+                for task_id, code, enqueued, deadline in TASK_RECORD.iter_unpack(data[records:])
+            ]
+        return [
+            (task_id, result if has_result else None, string,
+             {"picked_up": picked_up, "lock_wait": lock_wait, "completed": completed} if picked_up == picked_up else None)
+            for task_id, has_result, result, picked_up, lock_wait, completed in RESULT_RECORD.iter_unpack(data[records:])
+        ]
+    return pickle.loads(data)
+
+# Encoders by WIRE_FORMAT name
+ENCODERS = {"pickle": pickle_dumps, "compact": dumps}